@@ -0,0 +1,623 @@
+"""
+Helpers shared by the acquisition extensions (timelapse, wellscan, stagecalib, autocoupling)
+"""
+import io
+import os
+import json
+import time
+import logging
+import queue
+import threading
+
+import numpy as np
+try:
+    import cv2
+except:
+    print("CV2 is missing..only raw low-res captures will be available")
+
+from timing_utils import timer
+
+
+class RawFrameGrabber(object):
+    """
+    Grab small luma (grayscale) frames from the video port without JPEG encoding
+
+    The camera writes the raw YUV420 frame straight into a preallocated
+    buffer which is reused for every frame; the Y plane of it is the grayscale
+    image. If the camera can't deliver YUV, the JPEG encode/decode is used.
+
+        grabber = RawFrameGrabber(microscope.camera)
+        frame = grabber.grab()           # view into the reused buffer
+        brightness = grabber.mean()      # only the statistic
+
+    Args:
+        camera: camera with capture(output, fmt=..., use_video_port=..., resize=...)
+        resolution (tuple): (width, height) of the frames
+    """
+
+    def __init__(self, camera, resolution=(320, 240)):
+        self.camera = camera
+        self.resolution = resolution
+        width, height = resolution
+        # the camera pads the planes to multiples of 32 x 16
+        padded_width, padded_height = (width + 31) // 32 * 32, (height + 15) // 16 * 16
+        self.buffer = np.empty(padded_width * padded_height * 3 // 2, dtype=np.uint8)
+        self.luma = self.buffer[:padded_width * padded_height].reshape(padded_height, padded_width)[:height, :width]
+        self.offset = 0
+        self.raw = True
+        self.n_raw = 0
+        # one buffer per camera: a grab (and reading its frame) must not overlap with another one
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        # called by the camera with (parts of) the frame
+        data = np.frombuffer(data, dtype=np.uint8)
+        n = min(len(data), len(self.buffer) - self.offset)
+        self.buffer[self.offset:self.offset + n] = data[:n]
+        self.offset += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _grab_jpeg(self):
+        output = io.BytesIO()
+        self.camera.capture(output, use_video_port=True, resize=self.resolution)
+        frame = cv2.imdecode(np.frombuffer(output.getbuffer(), dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        self.luma[...] = frame[:self.luma.shape[0], :self.luma.shape[1]]
+        return self.luma
+
+    def _grab(self):
+        if self.raw:
+            try:
+                self.offset = 0
+                self.camera.capture(self, fmt="yuv", use_video_port=True, resize=self.resolution)
+                self.n_raw += 1
+                return self.luma
+            except Exception as e:
+                if self.n_raw:
+                    raise
+                # the raw path never worked with this camera
+                logging.warning("Raw YUV capture failed (%s), using JPEG", e)
+                self.raw = False
+        return self._grab_jpeg()
+
+    def grab(self, copy=False):
+        """
+        Grab a frame into the buffer and return its luma plane
+
+        Without copy the frame is a view which the next grab overwrites; use
+        copy=True if other threads may grab from the same camera.
+        """
+        with self.lock:
+            frame = self._grab()
+            return frame.copy() if copy else frame
+
+    def mean(self, downsample=4):
+        """Mean grey value of a new frame, computed on every downsample-th pixel"""
+        with self.lock:
+            return float(np.mean(self._grab()[::downsample, ::downsample]))
+
+
+# one reused grabber per camera
+raw_grabbers = {}
+
+
+raw_grabbers_lock = threading.Lock()
+
+
+def raw_grabber(camera):
+    with raw_grabbers_lock:
+        if id(camera) not in raw_grabbers:
+            raw_grabbers[id(camera)] = RawFrameGrabber(camera)
+        return raw_grabbers[id(camera)]
+
+
+def capture_in_background(camera):
+    """Grab a small grayscale frame from the video port without saving it"""
+    return raw_grabber(camera).grab(copy=True)
+
+
+def capture_mean(camera, downsample=4):
+    """Mean grey value of a small frame from the video port, without copying the frame"""
+    return raw_grabber(camera).mean(downsample)
+
+
+def data_path(microscope):
+    """Base directory of the microscope's captures"""
+    paths = getattr(microscope.captures, "paths", {})
+    return paths.get("default", os.path.expanduser("~/openflexure/data/micrographs"))
+
+
+def stack_path(microscope, folder, name):
+    """Directory for a FrameStack next to the microscope's other captures"""
+    return os.path.join(data_path(microscope), folder, name + "_stack")
+
+
+def trace_path(microscope, folder, name):
+    """Chrome trace file of a run next to its captures"""
+    return os.path.join(data_path(microscope), folder, name + "_trace.json")
+
+
+def quality_path(microscope, folder, name):
+    """Per-tile quality scores (JSON lines) of a run next to its captures"""
+    return os.path.join(data_path(microscope), folder, name + "_quality.jsonl")
+
+
+def occupancy_path(microscope, folder, name):
+    """Occupancy mask (JSON) of a plate scan next to its captures"""
+    return os.path.join(data_path(microscope), folder, name + "_occupancy.json")
+
+
+def append_jsonl(filename, entry):
+    """Append one JSON entry as a line, e.g. the scores of a tile"""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+
+def checkpoint_path(microscope, action):
+    """Checkpoint file of the last run of an action (e.g. "timelapse")"""
+    return os.path.join(data_path(microscope), action + "_checkpoint.json")
+
+
+class SettleDetector(object):
+    """
+    Wait until the image has stopped changing after a move or an illumination switch
+
+    Consecutive low-res frames are compared by their mean absolute difference;
+    once n_stable consecutive differences are below threshold the scene is
+    considered settled. This replaces fixed worst-case sleeps: timeout is the
+    longest we wait (the old constant), but we usually return much earlier.
+
+    A command may return before the hardware starts to move, so two still
+    frames right after it can both show the old state. Still frames only
+    count once a change has been seen or if they were grabbed at least
+    dead_time after the command.
+
+    Args:
+        grab (callable): grab() returns a new (2D or 3D) frame
+        threshold (float): mean absolute grey-value difference considered "still"
+        timeout (float): maximum time (s) to wait
+        n_stable (int): number of consecutive still frame pairs required
+        downsample (int): only every n-th pixel along each axis is compared
+        name (str): used in the log message
+        dead_time (float): time (s) after the command before still frames are trusted
+    """
+
+    def __init__(self, grab, threshold=2., timeout=1., n_stable=1, downsample=4, name="settle", dead_time=.1):
+        self.grab = grab
+        self.threshold = threshold
+        self.timeout = timeout
+        self.n_stable = n_stable
+        self.downsample = downsample
+        self.name = name
+        self.dead_time = dead_time
+        self.settle_times = []
+
+    def _lowres(self, frame):
+        frame = np.asarray(frame)[::self.downsample, ::self.downsample]
+        if frame.ndim == 3:
+            frame = np.mean(frame, -1, dtype=np.float32)
+        return frame.astype(np.float32)
+
+    def wait(self, timeout=None, t_command=None):
+        """
+        Block until the image is still or the timeout is reached
+
+        Args:
+            timeout (float): maximum time (s) to wait, default: self.timeout
+            t_command (float): time the command was sent, default: now
+
+        Returns:
+            t_settle (float): measured settle time in seconds
+            frame: the last (settled) frame, which can be used for the measurement
+        """
+        timeout = self.timeout if timeout is None else timeout
+        t_start = time.time() if t_command is None else t_command
+        with timer.span("settle", detector=self.name):
+            t_settle, frame = self._wait(t_start, timeout)
+        self.settle_times.append(t_settle)
+        return t_settle, frame
+
+    def _wait(self, t_start, timeout):
+        t_last = time.time()
+        frame = self.grab()
+        last = self._lowres(frame)
+        n_still = 0
+        changed = False
+        while True:
+            t_settle = time.time() - t_start
+            if t_settle >= timeout:
+                logging.warning("%s: not settled after %.3fs", self.name, t_settle)
+                break
+            t_grab = time.time()
+            frame = self.grab()
+            current = self._lowres(frame)
+            if np.mean(np.abs(current - last)) >= self.threshold:
+                changed = True
+                n_still = 0
+            elif changed or t_last - t_start >= self.dead_time:
+                n_still += 1
+                if n_still >= self.n_stable:
+                    t_settle = time.time() - t_start
+                    logging.info("%s: settled after %.3fs", self.name, t_settle)
+                    break
+            last, t_last = current, t_grab
+        return t_settle, frame
+
+
+class DeadlineScheduler(object):
+    """
+    Fire timepoints at absolute deadlines t_start + k * period
+
+    Unlike sleeping for the period after each round, the time spent for
+    capturing does not accumulate, so the series does not drift. Timepoints
+    which are fired late are recorded as overruns. If a round took longer
+    than a whole period the missed timepoints are either skipped
+    (policy="skip", the series stays on the time grid) or fired back to back
+    (policy="compress", every timepoint is acquired). max_backlog limits how
+    many missed timepoints are fired back to back, older ones are skipped;
+    e.g. after resuming a series that was interrupted for hours.
+
+    Iterating yields the index k of each timepoint:
+
+        for k in DeadlineScheduler(period=30, duration=3600):
+            acquire(k)
+
+    Args:
+        period (float): time (s) between two timepoints, 0 fires them back to back
+        duration (float): stop before the first deadline after this time (s); with
+            period 0 once this time has passed since t_start
+        n_points (int): stop after this many timepoints
+        policy (str): "skip" or "compress"
+        t_start (float): time of the first timepoint (default: now)
+        tolerance (float): lateness (s) not counted as overrun (default: 1% of the period)
+        k_start (int): first timepoint, e.g. to resume a series with its original t_start
+        stop_event (threading.Event): optional, ends the iteration as soon as it is set
+        max_backlog (int): with policy "compress", fire at most this many missed timepoints back to back
+    """
+
+    def __init__(self, period, duration=None, n_points=None, policy="skip", t_start=None,
+                 tolerance=None, k_start=0, stop_event=None, max_backlog=None):
+        if period < 0:
+            raise ValueError("The period must not be negative, got "+str(period))
+        self.period = period
+        self.max_backlog = max_backlog
+        self.stop_event = stop_event
+        self.k_start = k_start
+        self.tolerance = period * .01 if tolerance is None else tolerance
+        self.duration = duration
+        self.n_points = n_points
+        self.policy = policy
+        self.t_start = t_start
+        self.overruns = []
+        self.skipped = []
+        self.n_fired = 0
+
+    def deadline(self, k):
+        return self.t_start + k * self.period
+
+    def _done(self, k):
+        if self.n_points is not None and k >= self.n_points:
+            return True
+        if self.duration is None:
+            return False
+        if self.period > 0:
+            return k * self.period >= self.duration
+        # back to back timepoints have no deadlines to compare with
+        return time.time() - self.t_start >= self.duration
+
+    def __iter__(self):
+        if self.t_start is None:
+            self.t_start = time.time()
+        k = self.k_start
+        while not self._done(k):
+            lateness = time.time() - self.deadline(k)
+            if lateness < 0:
+                # sleep until the deadline (or until we are stopped)
+                if self.stop_event is not None:
+                    if self.stop_event.wait(-lateness):
+                        break
+                else:
+                    time.sleep(-lateness)
+            else:
+                n_missed = int(lateness // self.period) if self.period > 0 else 0
+                if self.policy != "skip":
+                    # only catch up on the last max_backlog missed timepoints
+                    n_missed = n_missed - self.max_backlog if self.max_backlog is not None else 0
+                if n_missed > 0:
+                    # jump to the last deadline which has already passed (or the oldest one we catch up on)
+                    self.skipped.extend(range(k, k + n_missed))
+                    k += n_missed
+                    if self._done(k):
+                        break
+                    lateness = time.time() - self.deadline(k)
+                if lateness > self.tolerance:
+                    self.overruns.append({"k": k, "lateness": lateness})
+            if self.stop_event is not None and self.stop_event.is_set():
+                break
+            self.n_fired += 1
+            yield k
+            k += 1
+
+    def stats(self):
+        lateness = [o["lateness"] for o in self.overruns]
+        return {
+            "n_fired": self.n_fired,
+            "n_overruns": len(self.overruns),
+            "n_skipped": len(self.skipped),
+            "skipped": list(self.skipped),
+            "max_lateness": max(lateness) if lateness else 0.,
+        }
+
+
+class CaptureWriter(object):
+    """
+    Capture into memory and write the images to disk in background threads
+
+    capture() only holds the camera for the grab itself (JPEG into a BytesIO)
+    and returns; a pool of writer threads creates the capture in the
+    microscope's capture manager, writes the file and stores tags,
+    annotations, dataset and metadata the way microscope.capture does.
+    Failed writes are collected in errors and reported by stats().
+    The queue is bounded: if the writers fall behind, capture() blocks until
+    there is space again (backpressure), so memory use stays limited.
+
+        with CaptureWriter(microscope) as writer:
+            for pos in positions:
+                microscope.stage.move_abs(pos)
+                writer.capture(filename=..., folder=...)
+
+    If a FrameStack is given, the encoded images are appended to the
+    stack at their (t, position, modality) key instead of being saved as
+    individual files; filename, tags and metadata are stored with them.
+
+    Args:
+        microscope: Microscope object
+        n_workers (int): number of writer threads
+        max_queue (int): maximum number of images waiting to be written
+        stack (FrameStack): optional stack to store the frames in
+    """
+
+    def __init__(self, microscope, n_workers=2, max_queue=8, stack=None):
+        self.microscope = microscope
+        self.stack = stack
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.n_captured = 0
+        self.n_written = 0
+        self.t_blocked = 0.
+        self.errors = []
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._write, daemon=True) for _ in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def capture(self, filename, folder="", temporary=False, use_video_port=False,
+                bayer=True, tags=None, annotations=None, dataset=None, metadata=None,
+                stack_key=(0, 0, 0)):
+        """
+        Grab an image into memory and queue it for writing
+
+        The arguments are those of microscope.capture; stack_key is the
+        (t, position, modality) of the frame if a stack is used.
+        """
+        stream = io.BytesIO()
+        with timer.span("capture", filename=filename), self.microscope.camera.lock:
+            self.microscope.camera.capture(stream, use_video_port=use_video_port, bayer=bayer)
+        # the metadata (e.g. the stage position) has to be taken at the time of the grab
+        metadata = dict(self.microscope.metadata if metadata is None else metadata)
+        self.n_captured += 1
+
+        t_start = time.time()
+        # the writer threads tag their spans with the run that captured the frame
+        self.queue.put((stream, filename, folder, temporary, tags, annotations, dataset, metadata, stack_key,
+                        timer.run))
+        self.t_blocked += time.time() - t_start
+        timer.record("capture queue", t_start, time.time() - t_start)
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            stream, filename, folder, temporary, tags, annotations, dataset, metadata, stack_key, run = item
+            t_start = time.time()
+            try:
+                if self.stack is not None:
+                    # keep what would have gone into the capture's metadata next to the frame
+                    info = {"filename": filename, "folder": folder, "tags": tags, "annotations": annotations,
+                            "dataset": dataset, "metadata": metadata}
+                    # the encoded image as it would have been written to its file
+                    self.stack.append(stream.getvalue(), *stack_key, info=info)
+                else:
+                    output = self.microscope.captures.new_image(
+                        temporary=temporary, filename=filename, folder=folder
+                    )
+                    with open(output.file, "wb") as f:
+                        f.write(stream.getbuffer())
+                    output.put_and_save(tags=tags, annotations=annotations, dataset=dataset, metadata=metadata)
+                with self._lock:
+                    self.n_written += 1
+            except Exception as e:
+                logging.error("Writing %s failed: %s", filename, e)
+                with self._lock:
+                    self.errors.append({"filename": filename, "error": str(e)})
+            finally:
+                timer.record("write", t_start, time.time() - t_start, run=run, filename=filename)
+                self.queue.task_done()
+
+    def flush(self):
+        """Block until all queued images are written"""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def stats(self):
+        with self._lock:
+            errors = list(self.errors)
+        return {
+            "n_captured": self.n_captured,
+            "n_written": self.n_written,
+            "n_errors": len(errors),
+            "errors": errors,
+            "t_blocked": self.t_blocked,
+        }
+
+
+class IlluminationScheduler(object):
+    """
+    Switch between imaging modalities with as few illumination commands as possible
+
+    The current LED and laser levels are remembered so that only commands which
+    change something are sent (e.g. no "laser off" if it is already off) and
+    we only wait for the illumination to settle after an actual switch. With
+    keep_on the light stays on between timepoints and the modality order is
+    reversed every other timepoint, so each timepoint starts with the modality
+    the previous one ended with.
+
+    Args:
+        stage: stage object with set_laser_intensity() and set_led()
+        i_laser (int): laser intensity for fluorescence
+        settle (SettleDetector): optional, waited for after every switch
+        keep_on (bool): keep the last modality on between timepoints
+    """
+
+    def __init__(self, stage, i_laser=255, settle=None, keep_on=False):
+        self.stage = stage
+        self.i_laser = i_laser
+        self.settle = settle
+        self.keep_on = keep_on
+        # unknown until we set it the first time
+        self.laser = None
+        self.led = None
+        self.n_commands = 0
+        self.n_switches = 0
+        self.t_switch = 0.
+
+    def levels(self, modality):
+        """(laser, led) levels for a modality; anything unknown means dark"""
+        if modality == "Fluorescence":
+            return int(self.i_laser), 0
+        if modality == "Brightfield":
+            return 0, 1
+        return 0, 0
+
+    def order(self, modalities, k):
+        """Order of the modalities at timepoint/position k"""
+        if self.keep_on and k % 2:
+            return list(modalities)[::-1]
+        return list(modalities)
+
+    def set(self, modality):
+        """Switch to modality; returns True if anything had to change"""
+        laser, led = self.levels(modality)
+        t_start = time.time()
+        # always switch off before switching on, so both are never on together
+        commands = []
+        if led != self.led and not led:
+            commands.append((self.stage.set_led, led))
+        if laser != self.laser and not laser:
+            commands.append((self.stage.set_laser_intensity, laser))
+        if laser != self.laser and laser:
+            commands.append((self.stage.set_laser_intensity, laser))
+        if led != self.led and led:
+            commands.append((self.stage.set_led, led))
+        for command, value in commands:
+            command(value)
+        self.laser, self.led = laser, led
+        if not commands:
+            return False
+
+        self.n_commands += len(commands)
+        self.n_switches += 1
+        if self.settle is not None and (laser or led):
+            self.settle.wait()
+        self.t_switch += time.time() - t_start
+        timer.record("illumination", t_start, time.time() - t_start, modality=modality)
+        return True
+
+    def off(self):
+        return self.set(None)
+
+    def end_timepoint(self):
+        """Call after every timepoint; switches the light off unless keep_on"""
+        if not self.keep_on:
+            self.off()
+
+    def stats(self):
+        return {
+            "n_commands": self.n_commands,
+            "n_switches": self.n_switches,
+            "t_switch": self.t_switch,
+        }
+
+
+class Checkpoint(object):
+    """
+    Persist the loop state of a long-running acquisition so it can be resumed
+
+    The state is a JSON-serialisable dict (parameters, output location,
+    counters, focus positions, ...) which is written atomically, so a
+    checkpoint is never half-written if the server dies. Saving is throttled
+    to once per interval unless forced; the caller should flush its
+    CaptureWriter before saving, so everything the checkpoint claims to be
+    done is on disk.
+
+        checkpoint = Checkpoint(checkpoint_path(microscope, "timelapse"))
+        state = checkpoint.load() if resume else {...}
+        ...
+        if checkpoint.due():
+            writer.flush()
+            checkpoint.save(state)
+
+    Args:
+        filename (str): checkpoint file
+        interval (float): minimum time (s) between two saves
+    """
+
+    def __init__(self, filename, interval=30.):
+        self.filename = filename
+        self.interval = interval
+        self.t_saved = 0.
+
+    def load(self):
+        """The last saved state, or None if there is nothing to resume"""
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("No checkpoint to resume in %s: %s", self.filename, e)
+            return None
+        if state.get("finished"):
+            logging.warning("The run in %s has already finished", self.filename)
+            return None
+        return state
+
+    def due(self):
+        return time.time() - self.t_saved >= self.interval
+
+    def save(self, state):
+        state = dict(state, t_checkpoint=time.time())
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.filename)
+        self.t_saved = time.time()
+
+    def finish(self, state):
+        """Mark the run as finished so that it isn't resumed again"""
+        self.save(dict(state, finished=True))
@@ -1,25 +1,28 @@
 from labthings.extensions import BaseExtension
 from labthings import find_component, fields
-from labthings.views import ActionView
+from labthings.views import ActionView, PropertyView
 from typing import Tuple
 from labthings.schema import Schema
 
 import time
 import io  # Used in our capture action
 import logging
+import threading
 
 # image processing libraries
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
-from scipy.ndimage import gaussian_filter
-from scipy.ndimage.measurements import center_of_mass
 from scipy.signal import chirp, find_peaks, peak_widths
 
-import serial
+from coupling_utils import FrameGrabber, CouplingTracker, couple_chip
+from coupling_utils import load_last_coupling, save_last_coupling
+from acquisition_utils import SettleDetector
+from hardware_utils import get_serial_connection, serial_stats
+from timing_utils import timer
 
 # Used to run our autocoupling in a background thread
 from labthings import update_action_progress as update_task_progress
+from labthings import current_action
 
 from openflexure_microscope.captures.capture_manager import (
     generate_basename,
@@ -42,6 +45,10 @@ serialport = "/dev/ttyUSB0"
 height = 240
 width = 320 
 exposuretime = 1 # minimum is 1 (int values only!)
+framerate = 120
+# time from the start of an exposure until buffcam delivers the frame: the exposure
+# (exposuretime * 100 us) plus about two frames in the nvargus pipeline
+camera_latency = exposuretime * 1e-4 + 2. / framerate
 
 # parameters for x/z coodinate search
 step_x_min = 0
@@ -53,6 +60,11 @@ step_z_max = 2000
 step_z_steps = 100
 
 
+# the running closed-loop coupling tracker (if any)
+coupling_tracker = None
+# the lens and the coupling camera belong to one action (coupling or tracking) at a time
+lens_lock = threading.Lock()
+
 # for debugging
 is_display = False
 if is_display: import matplotlib.pyplot as plt 
@@ -107,121 +119,137 @@ def auto_coupling(
     x_range,
     z_range,
     serialport,
-    is_display=False
+    is_display=False,
+    z_search="sweep",
+    n_coarse=5,
+    settle_threshold=2.,
+    settle_timeout=.2,
+    optimizer="sequential",
+    chip_id=None,
+    joint_tolerance=.01,
+    x_edge="discrete",
+    spot_metric="full"
 ):
 
+    # a coupling must not move the lens of a running tracker (or of another coupling)
+    if not lens_lock.acquire(blocking=False):
+        raise RuntimeError("The lens is in use by a running coupling or tracker, stop the tracker first")
+    try:
+        # connect to the lens/laser (the connection stays open between actions)
+        # open the lens and move it 
+        serialconnection = get_serial_connection(serialport, 115200, timeout=1)
+        print('Initializing Lens 1')
+        # init lens
+        lens_1 = serialconnection.device("lens_1", lens, lens_id = 1)
+        laser_1 = serialconnection.device("laser_1", laser, laser_id = 1)
+
+        # open camera
+        cap = buffcam.VideoCapture(gstreamer_pipeline(exposuretime=exposuretime,capture_width=width, capture_height = height, display_width=width, display_height=height, framerate=framerate, flip_method=0))#, cv2.CAP_GSTREAMER)
+        print("Camera is open")
+
+        # grab frames in the background so that we never read a stale frame after a lens move
+        grabber = FrameGrabber(cap, latency=camera_latency).start()
+
+        timer.start_run("autocoupling " + (chip_id or serialport))
+        try:
+            with timer.span("autocoupling"):
+                result = couple_chip(lens_1, grabber, x_range, z_range,
+                                     coupling_key=chip_id or serialport,
+                                     is_display=is_display,
+                                     z_search=z_search,
+                                     n_coarse=n_coarse,
+                                     settle_threshold=settle_threshold,
+                                     settle_timeout=settle_timeout,
+                                     optimizer=optimizer,
+                                     joint_tolerance=joint_tolerance,
+                                     x_edge=x_edge,
+                                     spot_metric=spot_metric)
+        finally:
+            print("This is the end; Closing the camera")
+            grabber.stop()
+            cap.release()
+
+        return result
+    finally:
+        lens_lock.release()
+
+
+def track_coupling(
+    x_range,
+    z_range,
+    serialport,
+    dither_x=50,
+    dither_z=50,
+    chip_id=None
+):
+    """
+    Keep the coupling at its optimum until stop_tracking() is called
 
-    # connect to the lens/laser
-    # open the lens and move it 
-    serialconnection = serial.Serial(serialport,115200,timeout=1) # Open grbl serial port
-    print('Initializing Lens 1')
-    # init lens
-    lens_1 = lens(serialconnection, lens_id = 1)
-    laser_1 = laser(serialconnection, laser_id = 1)
-
-    # open camera
-    cap = buffcam.VideoCapture(gstreamer_pipeline(exposuretime=exposuretime,capture_width=width, capture_height = height, display_width=width, display_height=height, flip_method=0))#, cv2.CAP_GSTREAMER)
-    print("Camera is open")
-
-    # let the camera warm up
-    for _ in range(20):
-        cap.read()
-
-    
-    # Start Super Fast Chip Coupling...
-
-    # First locate a reflection at the chip surface
-    # assume we place the lens at the lower part of the chip where you see good reflection of the spot 
-    pos_x = 0
-    pos_z = 0
-
-    # reset lens position:
-    lens_1.move(pos_x, "X")
-    lens_1.move(pos_z, "Z")
-
-    '''
-    1. Perform a focus of the spot relative to the chip's surface => smallest spot => in-focus
-    '''
-    #%%
-    ratios = []
-
-    # Capture Frame
-    for iz in z_range:
-        lens_1.move(iz, "Z")
-        time.sleep(.2)
-        _, img = cap.read() 
-
-        # only take green and blue channel to avoid oversaturation
-        img = np.mean(img[:,:,1:],-1)
-        
-        # let the camera warm up
-        img_filtered = gaussian_filter(img, 20)
-        #circles = cv2.HoughCircles(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.HOUGH_GRADIENT, 1.2, 100)
-        max_coords = np.where(np.max(img_filtered)==img_filtered)
-        img_masked = img_filtered*(img_filtered>np.max(img_filtered)*.5)
-        max_coords_COF = center_of_mass(img_masked)
-        ratio = np.sum(img_filtered>np.max(img_filtered)*.5) # if its smaller, it is more focussed
-        ratios.append(ratio)
-        print("Coord Z: "+str(iz)+", Ratio: "+str(ratio)) 
-        if(is_display):
-            plt.subplot(121)
-            plt.title('Filtered Frame at '+str(iz))
-            plt.imshow(img_filtered)
-            plt.subplot(122)
-            plt.imshow(img_masked)    
-            plt.plot(max_coords[1], max_coords[0], 'rx')
-            plt.plot(max_coords_COF[1], max_coords_COF[0], 'gx'), plt.show()
-
-
-    ratios = np.array(ratios)
-    if (is_display): plt.plot(z_range,ratios), plt.show()
-
-    # we define the focus as the position with highest intensity concentration / smallest spot size
-    pos_z = z_range[np.where(ratios==np.min(ratios))]
-    if type(pos_z)==np.ndarray:
-        pos_z=pos_z[0] # pick only one value
-    
-    # move lens to the position with highest concentration of the signal 
-    lens_1.move(pos_z, "Z")
-
-
-
-    '''
-    2. Perform adjustment of the lens along X by maximizing the intensity as a function of x 
-    Cost function -> argmax(I(x))
-    We assume that the exposure time is constant and the sensor is not overexposed
-    ''' 
-    # Bring focus position and edge in line
-    ratios = []
-
-    # move the lens along x
-    for ix in x_range:
-        lens_1.move(ix, "X")
-        time.sleep(.2)
-        _, img = cap.read() 
-    
-        # only take green and blue channel to avoid oversaturation
-        img = np.mean(img,-1)
-        ratio = np.mean(img)
-        ratios.append(ratio)
-        print("Coord X: "+str(ix)+", Ratio: "+str(ratio)) 
-
-    
-    myedge = np.roll(abs(ratios-np.roll(ratios,1)),-1)
-    myedge[0:2]=0; myedge[-3:]=0
-    pos_x = np.squeeze(x_range[np.squeeze((np.where(myedge==np.max(myedge))))-1])
-    
-    # move lens to the optimal position
-    lens_1.move(pos_x, "X")
-
-    if is_display: 
-        plt.plot(x_range,ratios)
-        plt.plot(x_range,myedge), plt.show()
+    The lens is dithered around the last good coupling position at camera
+    frame rate; camera and lens are opened once for the whole run. Only one
+    tracker can run at a time, and not while the chip is being coupled.
+    """
+    global coupling_tracker
+
+    # a second run must not take over the lens (and the stop button) of the running one
+    if not lens_lock.acquire(blocking=False):
+        raise RuntimeError("The lens is in use by a running coupling or tracker, stop the tracker first")
+    try:
+        # connect to the lens/laser
+        serialconnection = get_serial_connection(serialport, 115200, timeout=1)
+        lens_1 = serialconnection.device("lens_1", lens, lens_id = 1)
+
+        # open camera
+        cap = buffcam.VideoCapture(gstreamer_pipeline(exposuretime=exposuretime,capture_width=width, capture_height = height, display_width=width, display_height=height, framerate=framerate, flip_method=0))#, cv2.CAP_GSTREAMER)
+        grabber = FrameGrabber(cap, latency=camera_latency).start()
+        grabber.wait_frames(20)
+
+        # start from the last good coupling
+        coupling_key = chip_id or serialport
+        last_coupling = load_last_coupling(coupling_key)
+        if last_coupling is not None:
+            position = (last_coupling["pos_x"], last_coupling["pos_z"])
+        else:
+            position = (int(np.mean(x_range)), int(np.mean(z_range)))
+        print("Start tracking the coupling at X: "+str(position[0])+", Z: "+str(position[1]))
+
+        # every dither step is measured on a frame taken after the lens has settled
+        settle = SettleDetector(lambda: grabber.read_after(time.time())[1], timeout=.2,
+                                name="Lens", dead_time=.03)
+        coupling_tracker = CouplingTracker(
+            lens_1.move, grabber, position, (dither_x, dither_z),
+            ((np.min(x_range), np.max(x_range)), (np.min(z_range), np.max(z_range))),
+            settle=settle)
+
+        # also stop if the action itself gets cancelled
+        stopping = getattr(current_action(), "stopping", None)
+        def should_stop():
+            return stopping is not None and stopping.is_set()
+
+        try:
+            state = coupling_tracker.run(should_stop=should_stop)
+        finally:
+            if coupling_tracker.metric is not None:
+                save_last_coupling(coupling_key, coupling_tracker.position[0], coupling_tracker.position[1], coupling_tracker.metric)
+            print("Stopped tracking; Closing the camera")
+            grabber.stop()
+            cap.release()
+        return state
+    finally:
+        lens_lock.release()
+
+
+def stop_tracking():
+    if coupling_tracker is not None:
+        coupling_tracker.stop()
+    return tracking_state()
+
+
+def tracking_state():
+    if coupling_tracker is None:
+        return {"running": False}
+    return coupling_tracker.state()
 
-    print("This is the end; Closing the camera and serial connection")
-    cap.release()
-    serialconnection.close()
-    
 ## Extension views
 class AutocouplingAPI(ActionView):
     """
@@ -268,6 +296,11 @@ class AutocouplingAPI(ActionView):
         step_z_steps = args.get("step_z_steps")
 
         serialport = args.get("serialport") or {}
+        z_search = args.get("z_search")
+        optimizer = args.get("optimizer")
+        chip_id = args.get("chip_id")
+        x_edge = args.get("x_edge")
+        spot_metric = args.get("spot_metric")
 
         # Find our microscope component
         microscope = find_component("org.openflexure.microscope")
@@ -279,7 +312,12 @@ class AutocouplingAPI(ActionView):
             x_range,
             z_range,
             serialport,
-            is_display=False
+            is_display=False,
+            z_search=z_search,
+            optimizer=optimizer,
+            chip_id=chip_id,
+            x_edge=x_edge,
+            spot_metric=spot_metric
         )
 
 
@@ -304,9 +342,97 @@ class AutocouplingAPI(ActionView):
         ),      
         "serialport": fields.String(
             missing="/dev/ttyUSB0", example="/dev/ttyUSB0", description="Serialport"
+        ),
+        "z_search": fields.String(
+            missing="sweep", example="golden", description="Focus search in Z (sweep or golden)"
+        ),
+        "optimizer": fields.String(
+            missing="sequential", example="joint", description="Optimize Z then X (sequential) or both together (joint)"
+        ),
+        "chip_id": fields.String(
+            missing=None, allow_none=True, example="chip_1", description="Chip used to look up the last coupling"
+        ),
+        "x_edge": fields.String(
+            missing="discrete", example="fit", description="Edge detection in X (discrete or fit)"
+        ),
+        "spot_metric": fields.String(
+            missing="full", example="roi", description="Spot metric on the full frame or a tracked ROI (faster)"
+        )
+    }
+
+class AutocouplingTrackingAPI(ActionView):
+    """
+    Continuously track the chip coupling until stopped
+    """
+
+    args = {
+        "step_x_min": fields.Number(
+            missing=0, example=0, description="Lower limit for the Lens in X"
+        ),
+        "step_x_max": fields.Number(
+            missing=3000, example=3000, description="Upper limit for the Lens in X"
+        ),
+        "step_z_min": fields.Number(
+            missing=0, example=0, description="Lower limit for the Lens in Z"
+        ),
+        "step_z_max": fields.Number(
+            missing=2000, example=2000, description="Upper limit for the Lens in Z"
+        ),
+        "dither_x": fields.Number(
+            missing=50, example=50, description="Dither amplitude of the Lens in X"
+        ),
+        "dither_z": fields.Number(
+            missing=50, example=50, description="Dither amplitude of the Lens in Z"
+        ),
+        "serialport": fields.String(
+            missing="/dev/ttyUSB0", example="/dev/ttyUSB0", description="Serialport"
+        ),
+        "chip_id": fields.String(
+            missing=None, allow_none=True, example="chip_1", description="Chip used to look up the last coupling"
         )
     }
 
+    def post(self, args):
+        x_range = np.int32(np.array((args.get("step_x_min"), args.get("step_x_max"))))
+        z_range = np.int32(np.array((args.get("step_z_min"), args.get("step_z_max"))))
+
+        return track_coupling(
+            x_range,
+            z_range,
+            args.get("serialport"),
+            dither_x=args.get("dither_x"),
+            dither_z=args.get("dither_z"),
+            chip_id=args.get("chip_id")
+        )
+
+
+class AutocouplingTrackingStopAPI(ActionView):
+    """
+    Stop tracking the chip coupling
+    """
+
+    def post(self):
+        return stop_tracking()
+
+
+class AutocouplingTrackingStateAPI(PropertyView):
+    """
+    Current metric and lens position of the coupling tracker
+    """
+
+    def get(self):
+        return tracking_state()
+
+
+class SerialStatsAPI(PropertyView):
+    """
+    Timing statistics of the open lens/laser serial connections
+    """
+
+    def get(self):
+        return serial_stats()
+
+
 ## Extension GUI (OpenFlexure eV)
 # Alternate form without any dynamic parts
 extension_gui = {
@@ -374,8 +500,88 @@ extension_gui = {
                     "value": "/dev/ttyUSB0",
                     "options": ["/dev/ttyUSB0","/dev/ttyUSB1"],
                 },
+                {
+                    "fieldType": "selectList",
+                    "name": "z_search",
+                    "label": "Focus search in Z",
+                    "value": "sweep",
+                    "options": ["sweep","golden"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "optimizer",
+                    "label": "Coupling optimizer",
+                    "value": "sequential",
+                    "options": ["sequential","joint"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "x_edge",
+                    "label": "Edge detection in X",
+                    "value": "discrete",
+                    "options": ["discrete","fit"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "spot_metric",
+                    "label": "Spot metric",
+                    "value": "full",
+                    "options": ["full","roi"],
+                },
+                {
+                    "fieldType": "textInput",
+                    "name": "chip_id",
+                    "label": "Chip ID (warm start)",
+                    "value": "",
+                },
 
             ],
+        },
+        {
+            "name": "Track the coupling continuously",
+            "route": "/autocoupling-tracking",
+            "isTask": True,
+            "isCollapsible": True,
+            "submitLabel": "Start Tracking",
+            "schema": [
+                {
+                    "fieldType": "numberInput",
+                    "name": "dither_x",
+                    "label": "Dither amplitude in X",
+                    "min": 1.,  # HTML number input attribute
+                    "step": 10,  # HTML number input attribute
+                    "default": 50.,  # HTML number input attribute
+                },
+                {
+                    "fieldType": "numberInput",
+                    "name": "dither_z",
+                    "label": "Dither amplitude in Z",
+                    "min": 1.,  # HTML number input attribute
+                    "step": 10,  # HTML number input attribute
+                    "default": 50.,  # HTML number input attribute
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "serialport",
+                    "label": "Serial Port",
+                    "value": "/dev/ttyUSB0",
+                    "options": ["/dev/ttyUSB0","/dev/ttyUSB1"],
+                },
+                {
+                    "fieldType": "textInput",
+                    "name": "chip_id",
+                    "label": "Chip ID (warm start)",
+                    "value": "",
+                },
+            ],
+        },
+        {
+            "name": "Stop tracking the coupling",
+            "route": "/autocoupling-tracking/stop",
+            "isTask": True,
+            "isCollapsible": True,
+            "submitLabel": "Stop Tracking",
+            "schema": [],
         }
     ],
 }
@@ -388,9 +594,17 @@ autocoupling_extension = BaseExtension("org.openflexure.autocoupling_extension",
 
 # Add methods to your extension
 autocoupling_extension.add_method(auto_coupling, "auto_coupling")
+autocoupling_extension.add_method(track_coupling, "track_coupling")
+autocoupling_extension.add_method(stop_tracking, "stop_tracking")
+autocoupling_extension.add_method(tracking_state, "tracking_state")
+autocoupling_extension.add_method(get_serial_connection, "get_serial_connection")
 
 # Add API views to your extension
 autocoupling_extension.add_view(AutocouplingAPI, "/autocoupling")
+autocoupling_extension.add_view(AutocouplingTrackingAPI, "/autocoupling-tracking")
+autocoupling_extension.add_view(AutocouplingTrackingStopAPI, "/autocoupling-tracking/stop")
+autocoupling_extension.add_view(AutocouplingTrackingStateAPI, "/autocoupling-tracking/state")
+autocoupling_extension.add_view(SerialStatsAPI, "/autocoupling/serial")
 
 # Add OpenFlexure eV GUI to your extension
 autocoupling_extension.add_meta("gui", build_gui(extension_gui, autocoupling_extension))
@@ -0,0 +1,251 @@
+"""
+Hardware-free stand-ins for the autocoupling camera and lens
+
+SimulatedChip renders synthetic spot images for the current lens position
+(or replays a recorded frame stack indexed by (x, z)), SimulatedLens
+replaces the ESP32 lens and SimulatedVideoCapture replaces
+buffcam.VideoCapture. Lens moves take time to settle and every frame has
+shot noise, so the search modes of couple_chip can be compared on a plain
+Linux box:
+
+    python autocouple_simulator.py --runs 3
+    python autocouple_simulator.py --replay recorded_stack.npz
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from coupling_utils import FrameGrabber, couple_chip, save_last_coupling
+
+# Camera parameters (same as in autocouple_extension.py)
+height = 240
+width = 320
+
+
+class SimulatedChip(object):
+    """
+    Physical model of the lens in front of the chip
+
+    The spot is a gaussian whose width grows away from the focus z0. Along X
+    its brightness either drops at the chip edge x0 (profile="edge", the
+    reflection both coupling optimizers look for) or peaks at x0 (profile="peak",
+    a throughput signal as used by the tracker).
+    After a move the lens approaches its target exponentially (settle_tau).
+
+    Args:
+        x0, z0 (float): true coupling position
+        spot_w0 (float): spot radius (px) in focus
+        rayleigh (float): Z distance (steps) over which the spot doubles its area
+        x_width (float): width (steps) of the edge/peak along X
+        profile (str): "edge" or "peak"
+        contrast (float): relative brightness change across the edge/peak
+        noise (float): standard deviation of the camera noise (grey values)
+        settle_tau (float): time constant (s) of the lens motion
+        drift (tuple): drift of (x0, z0) in steps per second
+        replay (str): optional .npz file with "frames" (Nx, Nz, H, W, 3), "x" and "z"
+        seed (int): random seed for the noise
+    """
+
+    def __init__(self, x0=1530., z0=870., spot_w0=6., rayleigh=300., x_width=100.,
+                 profile="edge", contrast=.8, noise=1., settle_tau=.01, drift=(0., 0.),
+                 replay=None, seed=None):
+        self.x0, self.z0 = x0, z0
+        self.profile = profile
+        self.contrast = contrast
+        self.spot_w0 = spot_w0
+        self.rayleigh = rayleigh
+        self.x_width = x_width
+        self.noise = noise
+        self.settle_tau = settle_tau
+        self.drift = drift
+        self.rng = np.random.default_rng(seed)
+        self.t_start = time.time()
+        self.lock = threading.Lock()
+        # per axis: position before the last move, target, time of the move
+        self.axes = {"X": [0., 0., 0.], "Z": [0., 0., 0.]}
+        self.yy, self.xx = np.mgrid[:height, :width].astype(np.float32)
+
+        self.replay = None
+        if replay is not None:
+            stack = np.load(replay)
+            self.replay = (stack["frames"], stack["x"], stack["z"])
+
+    def move(self, axis, target):
+        with self.lock:
+            position = self.position(axis)
+            self.axes[axis] = [position, float(target), time.time()]
+
+    def position(self, axis, t=None):
+        start, target, t_move = self.axes[axis]
+        t = time.time() if t is None else t
+        if self.settle_tau <= 0:
+            return target
+        return target + (start - target) * np.exp(-max(t - t_move, 0) / self.settle_tau)
+
+    def optimum(self, t=None):
+        t = time.time() if t is None else t
+        return (self.x0 + self.drift[0] * (t - self.t_start),
+                self.z0 + self.drift[1] * (t - self.t_start))
+
+    def render(self, t=None):
+        """Frame (uint8, H x W x 3) exposed at time t"""
+        with self.lock:
+            x, z = self.position("X", t), self.position("Z", t)
+        if self.replay is not None:
+            frames, xs, zs = self.replay
+            frame = frames[np.argmin(np.abs(xs - x)), np.argmin(np.abs(zs - z))].astype(np.float32)
+        else:
+            x0, z0 = self.optimum(t)
+            w = self.spot_w0 * np.sqrt(1 + ((z - z0) / self.rayleigh)**2)
+            if self.profile == "peak":
+                brightness = 1 - self.contrast + self.contrast * np.exp(-((x - x0) / self.x_width)**2)
+            else:
+                brightness = 1 - self.contrast / (1 + np.exp(-(x - x0) / self.x_width))
+            amplitude = 200 * brightness * (self.spot_w0 / w)**2
+            r2 = (self.xx - width / 2)**2 + (self.yy - height / 2)**2
+            spot = 2 + amplitude * np.exp(-r2 / (2 * w**2))
+            frame = np.repeat(spot[:, :, np.newaxis], 3, -1)
+        frame = frame + self.rng.normal(0, self.noise, frame.shape)
+        return np.uint8(np.clip(frame, 0, 255))
+
+
+class SimulatedLens(object):
+    """Stand-in for openflexure_microscope.hardware.lens"""
+
+    def __init__(self, chip, lens_id=1, command_latency=.002):
+        self.chip = chip
+        self.lens_id = lens_id
+        self.command_latency = command_latency
+        self.n_moves = 0
+
+    def move(self, pos, axis):
+        time.sleep(self.command_latency)  # serial round trip
+        self.chip.move(axis, pos)
+        self.n_moves += 1
+
+
+class SimulatedVideoCapture(object):
+    """Stand-in for buffcam.VideoCapture delivering frames at a fixed framerate"""
+
+    def __init__(self, chip, framerate=120):
+        self.chip = chip
+        self.period = 1. / framerate
+        self.t_next = time.time()
+        self.n_frames = 0
+
+    def read(self):
+        # wait for the end of the next exposure
+        self.t_next = max(self.t_next + self.period, time.time())
+        time.sleep(max(self.t_next - time.time(), 0))
+        self.n_frames += 1
+        return True, self.chip.render(self.t_next - self.period / 2)
+
+    def release(self):
+        pass
+
+
+# search modes to compare: name -> (couple_chip kwargs and X step, use warm start)
+# all modes couple at the chip edge and are scored against the same chip
+benchmark_modes = {
+    "sweep": (dict(optimizer="sequential", z_search="sweep"), False),
+    "golden": (dict(optimizer="sequential", z_search="golden"), False),
+    "golden + ROI metric": (dict(optimizer="sequential", z_search="golden", spot_metric="roi"), False),
+    "golden + edge fit": (dict(optimizer="sequential", z_search="golden", x_edge="fit", x_step=200), False),
+    "joint": (dict(optimizer="joint"), False),
+    "joint (warm start)": (dict(optimizer="joint"), True),
+}
+
+
+def run_simulated_coupling(chip, x_range, z_range, warm_start=None, framerate=120, **kwargs):
+    """
+    Run couple_chip against the simulator
+
+    Returns:
+        dict with the result of couple_chip plus the wall "time", the camera
+        "n_frames", the number of lens moves and the position errors
+    """
+    lens_1 = SimulatedLens(chip)
+    cap = SimulatedVideoCapture(chip, framerate=framerate)
+    memory_fd, memory_file = tempfile.mkstemp(suffix=".json")
+    os.close(memory_fd)
+    if warm_start is not None:
+        save_last_coupling("simulator", warm_start[0], warm_start[1], filename=memory_file)
+    else:
+        os.remove(memory_file)
+
+    # a frame is delivered at the end of its exposure, which lasts one frame period
+    grabber = FrameGrabber(cap, latency=cap.period).start()
+    t_start = time.time()
+    try:
+        result = couple_chip(lens_1, grabber, x_range, z_range, "simulator",
+                             memory_file=memory_file, **kwargs)
+    finally:
+        grabber.stop()
+        if os.path.exists(memory_file):
+            os.remove(memory_file)
+    x0, z0 = chip.optimum()
+    result.update({
+        "time": time.time() - t_start,
+        "n_frames": cap.n_frames,
+        "n_moves": lens_1.n_moves,
+        "error_x": result["x_edge"] - x0,
+        "error_z": result["z_focus"] - z0,
+    })
+    return result
+
+
+def benchmark(modes=None, n_runs=3, replay=None, framerate=120, profile="edge", seed=0):
+    """
+    Run every search mode n_runs times and print frames, wall time and position errors
+
+    In every run all modes couple to the same simulated chip (position,
+    profile and noise) with the same warm start, so their errors are
+    measured against the same ground truth.
+    """
+    z_range = np.int32(np.arange(0, 2000, 100))
+    modes = modes or list(benchmark_modes)
+    rng = np.random.default_rng(seed)
+
+    results = {}
+    for i_run in range(n_runs):
+        # a new chip position for every run, the same for all modes
+        x0, z0 = rng.uniform(500, 2500), rng.uniform(300, 1700)
+        # pretend the chip drifted by a little since the last coupling
+        drifted = (x0 + rng.normal(0, 100), z0 + rng.normal(0, 100))
+        for mode in modes:
+            kwargs, use_warm_start = benchmark_modes[mode]
+            kwargs = dict(kwargs)
+            x_range = np.int32(np.arange(0, 3000, kwargs.pop("x_step", 50)))
+            # a fresh lens in front of an identical chip
+            chip = SimulatedChip(x0=x0, z0=z0, profile=profile, replay=replay, seed=seed + i_run)
+            warm_start = drifted if use_warm_start else None
+            result = run_simulated_coupling(chip, x_range, z_range, warm_start=warm_start,
+                                            framerate=framerate, **kwargs)
+            results.setdefault(mode, []).append(result)
+
+    print("%-20s %10s %10s %10s %12s %12s" % ("mode", "frames", "moves", "time [s]", "|err x|", "|err z|"))
+    summary = {}
+    for mode, runs in results.items():
+        summary[mode] = {key: float(np.mean([abs(r[key]) for r in runs]))
+                         for key in ("n_frames", "n_moves", "time", "error_x", "error_z")}
+        print("%-20s %10.1f %10.1f %10.2f %12.1f %12.1f" % (
+            mode, summary[mode]["n_frames"], summary[mode]["n_moves"], summary[mode]["time"],
+            summary[mode]["error_x"], summary[mode]["error_z"]))
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the autocoupling search modes without hardware")
+    parser.add_argument("--runs", type=int, default=3, help="number of simulated chips")
+    parser.add_argument("--modes", nargs="*", choices=list(benchmark_modes), help="search modes to compare")
+    parser.add_argument("--replay", default=None, help=".npz frame stack with frames, x and z")
+    parser.add_argument("--framerate", type=float, default=120, help="simulated camera framerate")
+    parser.add_argument("--profile", default="edge", choices=["edge", "peak"],
+                        help="brightness of the spot along X: drops at the chip edge or peaks at the coupling")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.modes, args.runs, args.replay, args.framerate, args.profile, args.seed)
@@ -0,0 +1,817 @@
+"""
+Helper functions for the automatic chip coupling (see autocouple_extension.py)
+
+Nothing in here depends on the microscope server or the Jetson camera so that
+the search algorithms can be used (and benchmarked, see autocouple_simulator.py)
+without the camera or the lens attached.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.ndimage import center_of_mass
+from scipy.optimize import curve_fit
+from scipy.special import erf
+
+from acquisition_utils import SettleDetector
+
+# golden ratio used for the golden-section search
+invphi = (np.sqrt(5) - 1) / 2
+
+
+def spot_size(img, sigma=20):
+    """
+    Compute the size of the focused spot in a frame
+
+    Args:
+        img (np.ndarray): BGR frame from the coupling camera
+        sigma (float): width of the gaussian smoothing kernel
+
+    Returns:
+        ratio (int): number of pixels above half maximum (smaller = more focused)
+        img_filtered (np.ndarray): smoothed frame
+        max_coords_COF (tuple): center of mass of the spot
+    """
+    # only take green and blue channel to avoid oversaturation
+    img = np.mean(img[:, :, 1:], -1)
+    img_filtered = gaussian_filter(img, sigma)
+    img_mask = img_filtered > np.max(img_filtered) * .5
+    max_coords_COF = center_of_mass(img_filtered * img_mask)
+    ratio = np.sum(img_mask)  # if its smaller, it is more focussed
+    return ratio, img_filtered, max_coords_COF
+
+
+def _bin(img, binning):
+    """Average binning x binning pixel blocks (crops the remainder)"""
+    if binning == 1:
+        return img
+    ny, nx = img.shape[0] // binning, img.shape[1] // binning
+    return img[:ny * binning, :nx * binning].reshape(ny, binning, nx, binning).mean((1, 3))
+
+
+class SpotMetric(object):
+    """
+    Fast spot metrics on a tracked region of interest
+
+    The spot is located once on a binned full frame; afterwards only a
+    roi_size x roi_size window around the last centroid is converted to
+    float32, binned and blurred (sigma/binning), which is much cheaper than
+    blurring the full float64 frame with sigma. Area, centroid and peak are
+    computed in the same pass. If the spot touches the border of the window
+    it is located on the full frame again for the next measurement.
+
+    Args:
+        sigma (float): width of the gaussian smoothing in full-resolution pixels
+        roi_size (int): size of the tracked window in full-resolution pixels
+        binning (int): binning factor applied before blurring
+    """
+
+    def __init__(self, sigma=20, roi_size=128, binning=4):
+        self.sigma = sigma
+        self.roi_size = roi_size
+        self.binning = binning
+        self.center = None
+        self.n_locate = 0
+
+    def _gray(self, img):
+        # only take green and blue channel to avoid oversaturation
+        if img.ndim == 3:
+            return np.mean(img[:, :, 1:], -1, dtype=np.float32)
+        return img.astype(np.float32)
+
+    def locate(self, img):
+        """Find the spot on the (binned) full frame"""
+        binned = gaussian_filter(_bin(self._gray(img), self.binning), self.sigma / self.binning)
+        iy, ix = np.unravel_index(np.argmax(binned), binned.shape)
+        self.center = ((iy + .5) * self.binning, (ix + .5) * self.binning)
+        self.n_locate += 1
+        return self.center
+
+    def measure(self, img):
+        """
+        Returns:
+            dict with the spot "area" (pixels above half maximum, smaller = more
+            focused), its "centroid" (y, x) in frame coordinates, the "peak" of
+            the smoothed spot and the "throughput" (intensity / area)
+        """
+        if self.center is None:
+            self.locate(img)
+        half = self.roi_size // 2
+        y0 = int(np.clip(self.center[0] - half, 0, max(img.shape[0] - self.roi_size, 0)))
+        x0 = int(np.clip(self.center[1] - half, 0, max(img.shape[1] - self.roi_size, 0)))
+        roi = _bin(self._gray(img[y0:y0 + self.roi_size, x0:x0 + self.roi_size]), self.binning)
+        blurred = gaussian_filter(roi, self.sigma / self.binning)
+
+        peak = float(blurred.max())
+        mask = blurred > peak * .5
+        weights = blurred * mask
+        total = float(weights.sum())
+        yy, xx = np.nonzero(mask)
+        w = weights[yy, xx]
+        cy = (float(np.dot(w, yy)) / total + .5) * self.binning + y0 if total else self.center[0]
+        cx = (float(np.dot(w, xx)) / total + .5) * self.binning + x0 if total else self.center[1]
+        area = int(np.count_nonzero(mask)) * self.binning**2
+
+        # follow the spot; search the full frame again if it leaves the window
+        touches_border = (yy.size == 0 or yy.min() == 0 or xx.min() == 0
+                          or yy.max() == mask.shape[0] - 1 or xx.max() == mask.shape[1] - 1)
+        self.center = None if touches_border else (cy, cx)
+
+        return {
+            "area": area,
+            "centroid": (cy, cx),
+            "peak": peak,
+            "throughput": float(blurred.sum()) * self.binning**2 / max(area, 1),
+        }
+
+
+def parabolic_minimum(x, y):
+    """
+    Vertex of the parabola through three points (x, y)
+
+    Falls back to the best sampled point if the points are collinear
+    or the parabola opens downwards.
+    """
+    x0, x1, x2 = x
+    y0, y1, y2 = y
+    denom = (x0 - x1) * (x0 - x2) * (x1 - x2)
+    a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / denom if denom else 0
+    if a <= 0:
+        return x[int(np.argmin(y))]
+    b = (x2**2 * (y0 - y1) + x1**2 * (y2 - y0) + x0**2 * (y1 - y2)) / denom
+    return np.clip(-b / (2 * a), min(x), max(x))
+
+
+def golden_focus_search(measure, z_min, z_max, n_coarse=5, tolerance=50):
+    """
+    Coarse-to-fine search for the minimum of a focus metric along Z
+
+    First the range [z_min, z_max] is sampled at n_coarse equidistant positions
+    to bracket the minimum, then the bracket is narrowed by a golden-section
+    search until it is smaller than tolerance. The final (sub-step) estimate is
+    the vertex of a parabola through the three best evaluated positions.
+
+    Args:
+        measure (callable): measure(z) moves to z and returns the metric (smaller = better)
+        z_min (int): lower end of the search range
+        z_max (int): upper end of the search range
+        n_coarse (int): number of positions for the coarse bracket
+        tolerance (int): stop once the bracket is narrower than this
+
+    Returns:
+        dict with the focus estimate "z", the best measured position "z_best",
+        its metric "metric", the number of frames used "n_frames" and all
+        evaluated "positions"/"values"
+    """
+    cache = {}
+
+    def evaluate(z):
+        # the lens only accepts integer steps; don't measure a position twice
+        z = int(round(z))
+        if z not in cache:
+            cache[z] = measure(z)
+        return cache[z]
+
+    # 1. coarse bracket
+    z_coarse = np.linspace(z_min, z_max, max(n_coarse, 3))
+    values = [evaluate(z) for z in z_coarse]
+    i_min = int(np.argmin(values))
+    a = z_coarse[max(i_min - 1, 0)]
+    b = z_coarse[min(i_min + 1, len(z_coarse) - 1)]
+
+    # 2. golden-section refinement inside the bracket
+    c = b - invphi * (b - a)
+    d = a + invphi * (b - a)
+    while abs(b - a) > tolerance:
+        if evaluate(c) < evaluate(d):
+            b = d
+        else:
+            a = c
+        c = b - invphi * (b - a)
+        d = a + invphi * (b - a)
+
+    # 3. parabolic interpolation through the best three positions
+    positions = np.array(list(cache.keys()))
+    values = np.array(list(cache.values()))
+    order = np.argsort(positions)
+    positions, values = positions[order], values[order]
+    i_best = int(np.argmin(values))
+    i_best = min(max(i_best, 1), len(positions) - 2)
+    z_focus = parabolic_minimum(positions[i_best - 1:i_best + 2], values[i_best - 1:i_best + 2])
+
+    return {
+        "z": float(z_focus),
+        "z_best": int(positions[np.argmin(values)]),
+        "metric": float(np.min(values)),
+        "n_frames": len(cache),
+        "positions": positions.tolist(),
+        "values": values.tolist(),
+    }
+
+
+def edge_model(x, offset, height, x0, width):
+    """Error-function step from offset to offset+height at x0"""
+    return offset + height * .5 * (1 + erf((x - x0) / (np.sqrt(2) * width)))
+
+
+def fit_edge(x, intensity):
+    """
+    Locate the chip edge in an intensity-versus-X trace with sub-step precision
+
+    An error-function step (edge_model) is fitted to the trace, starting from
+    the steepest discrete step. If the fit fails or ends up outside the
+    scanned range, the steepest step is returned with one step as uncertainty.
+
+    Returns:
+        dict with the edge position "x", its standard deviation "std",
+        the edge "width" and whether the fit succeeded ("fit")
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(intensity, dtype=float)
+    step = np.abs(np.mean(np.diff(x)))
+    i_step = int(np.argmax(np.abs(np.diff(y))))
+    x_guess = (x[i_step] + x[i_step + 1]) / 2
+    guess = {"x": float(x_guess), "std": float(step), "width": float(step), "fit": False}
+    if len(x) < 4:
+        # fewer points than parameters of the edge model
+        return guess
+
+    n_edge = max(len(y) // 10, 1)
+    p0 = (np.mean(y[:n_edge]), np.mean(y[-n_edge:]) - np.mean(y[:n_edge]), x_guess, step)
+    try:
+        popt, pcov = curve_fit(edge_model, x, y, p0=p0, maxfev=2000)
+    except (RuntimeError, ValueError, TypeError):
+        return guess
+    x0, std = popt[2], np.sqrt(np.abs(pcov[2, 2]))
+    if not np.isfinite(x0) or not np.isfinite(std) or not x.min() <= x0 <= x.max():
+        return guess
+    return {"x": float(x0), "std": float(std), "width": float(abs(popt[3])), "fit": True}
+
+
+def coupling_metric(img, sigma=20):
+    """
+    Throughput metric for the joint X/Z optimisation (larger = better coupled)
+
+    The intensity of the spot divided by its size: it grows with the coupled
+    intensity (argmax I(x)) as well as with the focus (smallest spot).
+    """
+    ratio, img_filtered, _ = spot_size(img, sigma)
+    return float(np.sum(img_filtered)) / max(ratio, 1)
+
+
+def pattern_search(measure, x0, steps, min_steps, bounds, tolerance=0., max_evals=100):
+    """
+    Derivative-free compass search for the maximum of measure(x, z)
+
+    Starting at x0, every axis is probed in both directions with the current
+    step size. We move to any probe which improves the metric by more than
+    the relative tolerance, otherwise all step sizes are halved. The search stops once
+    all steps are below min_steps or after max_evals measurements.
+
+    Args:
+        measure (callable): measure(x, z) moves there and returns the metric
+        x0 (tuple): start position (x, z)
+        steps (tuple): initial step sizes (dx, dz)
+        min_steps (tuple): smallest step sizes (dx, dz)
+        bounds (tuple): ((x_min, x_max), (z_min, z_max))
+        tolerance (float): minimum relative improvement of the metric to accept a move
+        max_evals (int): maximum number of measurements
+
+    Returns:
+        dict with the best position "x"/"z", its "metric", "n_frames" and
+        whether the steps shrank below min_steps ("converged") before max_evals
+    """
+    cache = {}
+
+    def evaluate(pos):
+        pos = tuple(int(round(np.clip(p, *b))) for p, b in zip(pos, bounds))
+        if pos not in cache:
+            cache[pos] = measure(*pos)
+        return pos, cache[pos]
+
+    best, best_value = evaluate(x0)
+    steps = np.array(steps, dtype=float)
+    min_steps = np.array(min_steps, dtype=float)
+    while np.any(steps >= min_steps) and len(cache) < max_evals:
+        improved = False
+        for axis in range(len(best)):
+            if len(cache) >= max_evals:
+                break
+            if steps[axis] < min_steps[axis]:
+                continue
+            for direction in (1, -1):
+                probe = np.array(best, dtype=float)
+                probe[axis] += direction * steps[axis]
+                pos, value = evaluate(probe)
+                if value > best_value + tolerance * abs(best_value):
+                    best, best_value, improved = pos, value, True
+                    break
+                if len(cache) >= max_evals:
+                    break
+        if not improved:
+            steps /= 2
+
+    return {
+        "x": int(best[0]),
+        "z": int(best[1]),
+        "metric": float(best_value),
+        "n_frames": len(cache),
+        "converged": bool(np.all(steps < min_steps)),
+    }
+
+
+# last successful coupling positions, stored per serial port/chip
+coupling_memory_file = os.path.join(os.path.expanduser("~"), ".uc2_autocoupling.json")
+
+
+def load_last_coupling(key, filename=coupling_memory_file):
+    """Return the last good coupling {"pos_x", "pos_z", ...} for key or None"""
+    try:
+        with open(filename) as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def save_last_coupling(key, pos_x, pos_z, metric=None, filename=coupling_memory_file):
+    """Remember a good coupling position for key"""
+    try:
+        with open(filename) as f:
+            memory = json.load(f)
+    except (OSError, ValueError):
+        memory = {}
+    memory[key] = {"pos_x": int(pos_x), "pos_z": int(pos_z), "metric": metric, "time": time.time()}
+    with open(filename, "w") as f:
+        json.dump(memory, f, indent=2)
+
+
+class FrameGrabber(object):
+    """
+    Continuously read frames from a cv2/buffcam VideoCapture in a background thread
+
+    The last n_buffer frames are kept in a ring buffer together with the
+    (earliest possible) start of their exposure, so that a caller can wait
+    for the first frame which was exposed after e.g. a lens move finished
+    instead of reading a stale frame from the camera's queue.
+
+    A frame is stamped once read() has returned it, minus the latency of the
+    camera: the time from the start of an exposure until the frame is
+    delivered (exposure, readout and frames queued in the pipeline). Stamping
+    the request instead would let a frame from the queue, exposed before the
+    request, pass as a new one.
+
+    Args:
+        cap: object with a read() -> (ret, frame) method
+        n_buffer (int): number of frames kept in the ring buffer
+        latency (float): time (s) from the start of the exposure until read() returns the frame;
+            None: the measured frame interval (unbuffered camera)
+    """
+
+    def __init__(self, cap, n_buffer=8, latency=None):
+        self.cap = cap
+        self.latency = latency
+        self.frame_interval = None
+        self.frames = deque(maxlen=n_buffer)
+        self.n_frames = 0
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._grab, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        with self._condition:
+            self._condition.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _grab(self):
+        t_last = None
+        while self._running:
+            ret, frame = self.cap.read()
+            t_read = time.time()
+            if not ret or frame is None:
+                time.sleep(.001)
+                continue
+            if t_last is not None:
+                # running estimate of the frame interval
+                interval = t_read - t_last
+                self.frame_interval = interval if self.frame_interval is None else .9 * self.frame_interval + .1 * interval
+            t_last = t_read
+            if self.latency is not None:
+                latency = self.latency
+            else:
+                # the first frame may have waited in the queue for any time: never count it as new
+                latency = self.frame_interval if self.frame_interval is not None else float("inf")
+            with self._condition:
+                self.frames.append((t_read - latency, frame))
+                self.n_frames += 1
+                self._condition.notify_all()
+
+    def latest(self):
+        """Return (timestamp, frame) of the newest frame or (None, None)"""
+        with self._condition:
+            if not self.frames:
+                return None, None
+            return self.frames[-1]
+
+    def read_after(self, t, timeout=2.):
+        """
+        Return (timestamp, frame) of the first frame exposed after time t
+
+        Blocks until such a frame has arrived; raises TimeoutError otherwise.
+        """
+        t_end = time.time() + timeout
+        with self._condition:
+            while True:
+                for t_frame, frame in self.frames:
+                    if t_frame >= t:
+                        return t_frame, frame
+                t_remaining = t_end - time.time()
+                if t_remaining <= 0 or not self._running:
+                    raise TimeoutError("No frame exposed after "+str(t)+" within "+str(timeout)+"s")
+                self._condition.wait(t_remaining)
+
+    def read(self):
+        """Drop-in replacement for VideoCapture.read() that never returns a stale frame"""
+        _, frame = self.read_after(time.time())
+        return True, frame
+
+    def wait_frames(self, n_frames, timeout=5.):
+        """Block until at least n_frames have been grabbed since start"""
+        t_end = time.time() + timeout
+        with self._condition:
+            while self.n_frames < n_frames and time.time() < t_end and self._running:
+                self._condition.wait(t_end - time.time())
+        return self.n_frames
+
+
+class CouplingTracker(object):
+    """
+    Keep the coupling at its optimum by dithering the lens around the current position
+
+    Every iteration one axis is probed at +dither and -dither around the
+    current position, using the first frame exposed after the move. The
+    lens stays at whichever of the three positions gives the largest
+    throughput metric, so the loop follows slow (e.g. thermal) drifts at
+    camera frame rate without re-running the full coupling.
+
+    Args:
+        move (callable): move(pos, axis) moves the lens, e.g. lens.move
+        grabber (FrameGrabber): running frame grabber of the coupling camera
+        position (tuple): start position (x, z)
+        dither (tuple): dither amplitudes (dx, dz)
+        bounds (tuple): ((x_min, x_max), (z_min, z_max))
+        metric (callable): metric(frame) -> float, larger = better (default: SpotMetric throughput)
+        frame_delay (float): time (s) the lens needs before a frame is usable
+        settle (SettleDetector): wait for the image to settle instead of frame_delay
+        callback (callable): called with the state dict after every iteration
+    """
+
+    axes = ("X", "Z")
+
+    def __init__(self, move, grabber, position, dither, bounds, metric=None,
+                 frame_delay=.2, settle=None, callback=None):
+        self.move = move
+        self.grabber = grabber
+        self.position = [int(p) for p in position]
+        self.dither = dither
+        self.bounds = bounds
+        self.spot = SpotMetric()
+        self.metric_fn = metric or (lambda frame: self.spot.measure(frame)["throughput"])
+        self.frame_delay = frame_delay
+        self.settle = settle
+        self.callback = callback
+        self.metric = None
+        self.n_iterations = 0
+        self.running = False
+        self._stop = threading.Event()
+
+    def _measure(self):
+        if self.settle is not None:
+            _, frame = self.settle.wait()
+        else:
+            _, frame = self.grabber.read_after(time.time() + self.frame_delay)
+        return self.metric_fn(frame)
+
+    def _goto(self, axis, pos):
+        self.move(pos, self.axes[axis])
+
+    def step(self, axis):
+        """Dither along one axis and keep the best of the three positions"""
+        center = self.position[axis]
+        best, best_metric = center, self._measure()
+        current = center
+        for direction in (1, -1):
+            probe = int(np.clip(center + direction * self.dither[axis], *self.bounds[axis]))
+            if probe == center:
+                continue
+            self._goto(axis, probe)
+            current = probe
+            value = self._measure()
+            if value > best_metric:
+                best, best_metric = probe, value
+                break
+        if current != best:
+            self._goto(axis, best)
+        self.position[axis] = best
+        self.metric = best_metric
+        self.n_iterations += 1
+
+    def state(self):
+        return {
+            "running": self.running,
+            "pos_x": self.position[0],
+            "pos_z": self.position[1],
+            "metric": self.metric,
+            "n_iterations": self.n_iterations,
+        }
+
+    def run(self, should_stop=None):
+        """Track until stop() is called or should_stop() returns True"""
+        self.running = True
+        self._stop.clear()
+        for axis in range(len(self.axes)):
+            self._goto(axis, self.position[axis])
+        try:
+            while not self._stop.is_set() and not (should_stop and should_stop()):
+                self.step(self.n_iterations % len(self.axes))
+                if self.callback is not None:
+                    self.callback(self.state())
+        finally:
+            self.running = False
+        return self.state()
+
+    def stop(self):
+        self._stop.set()
+
+
+def couple_chip(
+    lens_1,
+    grabber,
+    x_range,
+    z_range,
+    coupling_key,
+    is_display=False,
+    z_search="sweep",
+    n_coarse=5,
+    settle_threshold=2.,
+    settle_timeout=.2,
+    settle_dead_time=.03,
+    optimizer="sequential",
+    joint_tolerance=.01,
+    spot_metric="full",
+    x_edge="discrete",
+    memory_file=coupling_memory_file
+):
+    """
+    Couple the laser into the chip with an already opened lens and camera
+
+    This is the hardware independent part of auto_coupling so that it can also
+    be run against the simulator (autocouple_simulator.py).
+
+    Args:
+        lens_1: lens object with a move(pos, axis) method
+        grabber (FrameGrabber): running frame grabber of the coupling camera
+        x_range (np.ndarray): lens positions for the scan in X
+        z_range (np.ndarray): lens positions for the scan in Z
+        coupling_key (str): serial port or chip used to store the warm start
+        z_search (str): "sweep" or "golden" focus search (sequential optimizer)
+        optimizer (str): "sequential" (Z then X) or "joint" (X and Z together), both
+            couple at the steepest intensity step of the chip edge with the spot in focus
+        spot_metric (str): "full" frame metrics or "roi" (SpotMetric on a tracked 128 px window:
+            faster, but the spot area saturates at the window and light outside it is ignored)
+        x_edge (str): "discrete" (centre of the steepest step) or "fit" (sub-step error-function fit) edge in X
+        memory_file (str): where the last good couplings are stored
+
+    Returns:
+        dict with the final "pos_x"/"pos_z", the sub-step "z_focus" and
+        the number of frames used for the focus "n_frames_z", the
+        (sub-step) edge position "x_edge" with its uncertainty "x_edge_std",
+        the coupling "metric" at the final position and whether it was
+        stored as the next warm start ("valid")
+    """
+    if is_display: import matplotlib.pyplot as plt
+
+    spot = SpotMetric()
+
+    # wait for the image to stop changing after a lens move instead of a fixed delay
+    # only frames exposed after the request are compared, and still frames only count
+    # settle_dead_time after the move command (or once the spot has started to move)
+    settle = SettleDetector(lambda: grabber.read_after(time.time())[1],
+                            threshold=settle_threshold, timeout=settle_timeout, name="Lens",
+                            dead_time=settle_dead_time)
+
+    
+    # Start Super Fast Chip Coupling...
+
+    # the last good coupling for this chip/port is our warm start
+    last_coupling = load_last_coupling(coupling_key, memory_file)
+
+    if optimizer == "joint":
+        '''
+        Search X and Z together (compass search) starting from the last good coupling
+        Cost function -> argmax(|I(x - dx) - I(x + dx)| / spot size)
+        The same target as the sequential search: the steepest step of the
+        intensity at the chip edge, with the smallest (in focus) spot
+        '''
+        dx = np.abs(np.mean(np.diff(x_range)))
+        dz = np.abs(np.mean(np.diff(z_range)))
+        x_bounds = (np.min(x_range) + dx, np.max(x_range) - dx)
+        z_bounds = (np.min(z_range), np.max(z_range))
+        current = {"X": None, "Z": None}
+        frames = {}
+        # let the camera warm up
+        grabber.wait_frames(20)
+
+        def measure_frame(ix, iz):
+            # intensity and spot size of one lens position, every position is only measured once
+            ix, iz = int(ix), int(iz)
+            if (ix, iz) not in frames:
+                # only send a command for the axis that actually moves
+                for axis, pos in (("X", ix), ("Z", iz)):
+                    if current[axis] != pos:
+                        lens_1.move(pos, axis)
+                        current[axis] = pos
+                _, img = settle.wait()
+                area = spot.measure(img)["area"] if spot_metric == "roi" else spot_size(img)[0]
+                frames[(ix, iz)] = (float(np.mean(img)), max(float(area), 1.))
+            return frames[(ix, iz)]
+
+        if last_coupling is not None:
+            # small drift => start close to the optimum with small steps
+            pos_x, pos_z = last_coupling["pos_x"], last_coupling["pos_z"]
+            steps = (2*dx, 2*dz)
+        else:
+            # the edge signal is flat away from the edge => locate it with a coarse X scan first
+            pos_z = int(np.mean(z_range))
+            x_coarse = np.linspace(x_bounds[0], x_bounds[1], 9).astype(int)
+            intensities = np.array([measure_frame(ix, pos_z)[0] for ix in x_coarse])
+            i_edge = int(np.argmax(np.abs(np.diff(intensities))))
+            pos_x = int(x_coarse[i_edge] + x_coarse[i_edge + 1]) // 2
+            steps = (np.abs(x_coarse[1] - x_coarse[0]) / 2, np.ptp(z_range) / 4)
+        print("Start joint coupling at X: "+str(pos_x)+", Z: "+str(pos_z))
+
+        def measure_xz(ix, iz):
+            lower, upper = measure_frame(ix - dx, iz), measure_frame(ix + dx, iz)
+            metric = abs(lower[0] - upper[0]) / ((lower[1] + upper[1]) / 2)
+            print("Coord X: "+str(ix)+", Coord Z: "+str(iz)+", Metric: "+str(metric))
+            return metric
+
+        coupling = pattern_search(measure_xz, (pos_x, pos_z), steps, (dx/2, dz/2),
+                                  (x_bounds, z_bounds), tolerance=joint_tolerance)
+        pos_x, pos_z = coupling["x"], coupling["z"]
+        z_focus = float(pos_z)
+        x_edge_pos, x_edge_std = float(pos_x), dx/2
+        n_frames_z = len(frames)
+        converged = coupling["converged"]
+        print("Joint coupling at X: "+str(pos_x)+", Z: "+str(pos_z)+" after "+str(n_frames_z)+" frames")
+
+        # move lens to the optimal position
+        lens_1.move(pos_x, "X")
+        lens_1.move(pos_z, "Z")
+    else:
+        # First locate a reflection at the chip surface
+        # assume we place the lens at the lower part of the chip where you see good reflection of the spot 
+        pos_x = 0
+        pos_z = 0
+
+        # reset lens position:
+        lens_1.move(pos_x, "X")
+        lens_1.move(pos_z, "Z")
+
+        # let the camera warm up (while the lens is resetting)
+        grabber.wait_frames(20)
+
+        '''
+        1. Perform a focus of the spot relative to the chip's surface => smallest spot => in-focus
+        '''
+        #%%
+        def measure_z(iz):
+            lens_1.move(iz, "Z")
+            # first frame exposed after the lens has settled
+            _, img = settle.wait()
+
+            if spot_metric == "roi" and not is_display:
+                ratio = spot.measure(img)["area"]
+                print("Coord Z: "+str(iz)+", Ratio: "+str(ratio)) 
+                return ratio
+
+            ratio, img_filtered, max_coords_COF = spot_size(img)
+            print("Coord Z: "+str(iz)+", Ratio: "+str(ratio)) 
+            if(is_display):
+                max_coords = np.where(np.max(img_filtered)==img_filtered)
+                plt.subplot(121)
+                plt.title('Filtered Frame at '+str(iz))
+                plt.imshow(img_filtered)
+                plt.subplot(122)
+                plt.imshow(img_filtered*(img_filtered>np.max(img_filtered)*.5))    
+                plt.plot(max_coords[1], max_coords[0], 'rx')
+                plt.plot(max_coords_COF[1], max_coords_COF[0], 'gx'), plt.show()
+            return ratio
+
+        if z_search == "golden":
+            # bracket the focus coarsely and refine it with a golden-section search
+            focus = golden_focus_search(measure_z, np.min(z_range), np.max(z_range),
+                                        n_coarse=n_coarse, tolerance=np.abs(np.mean(np.diff(z_range))))
+            print("Focus estimate Z: "+str(focus["z"])+" after "+str(focus["n_frames"])+" frames")
+            z_focus = focus["z"]
+            pos_z = int(round(z_focus))
+            n_frames_z = focus["n_frames"]
+            if (is_display): plt.plot(focus["positions"],focus["values"]), plt.show()
+        else:
+            ratios = np.array([measure_z(iz) for iz in z_range])
+            if (is_display): plt.plot(z_range,ratios), plt.show()
+
+            # we define the focus as the position with highest intensity concentration / smallest spot size
+            pos_z = z_range[np.where(ratios==np.min(ratios))]
+            if type(pos_z)==np.ndarray:
+                pos_z=pos_z[0] # pick only one value
+            z_focus = float(pos_z)
+            n_frames_z = len(z_range)
+    
+        # move lens to the position with highest concentration of the signal 
+        lens_1.move(pos_z, "Z")
+
+
+
+        '''
+        2. Perform adjustment of the lens along X by maximizing the intensity as a function of x 
+        Cost function -> argmax(I(x))
+        We assume that the exposure time is constant and the sensor is not overexposed
+        ''' 
+        # Bring focus position and edge in line
+        ratios = []
+
+        # move the lens along x
+        for ix in x_range:
+            lens_1.move(ix, "X")
+            _, img = settle.wait()
+    
+            # only take green and blue channel to avoid oversaturation
+            img = np.mean(img,-1)
+            ratio = np.mean(img)
+            ratios.append(ratio)
+            print("Coord X: "+str(ix)+", Ratio: "+str(ratio)) 
+
+    
+        myedge = np.roll(abs(ratios-np.roll(ratios,1)),-1)
+        myedge[0:2]=0; myedge[-3:]=0
+        if x_edge == "fit":
+            # fit the edge => precision below one step even for coarse scans
+            edge = fit_edge(x_range, ratios)
+            print("Edge X: "+str(edge["x"])+" +/- "+str(edge["std"]))
+            x_edge_pos, x_edge_std = edge["x"], edge["std"]
+            pos_x = int(round(x_edge_pos))
+        else:
+            # centre of the steepest step, the same target as the fit
+            i_edge = int(np.argmax(myedge))
+            x_edge_pos = float(x_range[i_edge] + x_range[i_edge + 1]) / 2
+            x_edge_std = float(np.abs(np.mean(np.diff(x_range))))
+            pos_x = int(round(x_edge_pos))
+    
+        # move lens to the optimal position
+        lens_1.move(pos_x, "X")
+
+        if is_display: 
+            plt.plot(x_range,ratios)
+            plt.plot(x_range,myedge), plt.show()
+
+        converged = True
+
+    # the metric of the final position, the same for both optimizers
+    _, img = settle.wait()
+    metric = spot.measure(img)["throughput"] if spot_metric == "roi" else coupling_metric(img)
+
+    # only a good coupling becomes the warm start of the next run: the optimum has to lie
+    # inside the scanned ranges (not cut off by them) and the search has to have finished
+    at_edge = (pos_x <= np.min(x_range) or pos_x >= np.max(x_range)
+               or pos_z <= np.min(z_range) or pos_z >= np.max(z_range))
+    valid = bool(converged and not at_edge and np.isfinite(metric) and metric > 0)
+    if valid:
+        save_last_coupling(coupling_key, pos_x, pos_z, float(metric), memory_file)
+    else:
+        print("Coupling at X: "+str(pos_x)+", Z: "+str(pos_z)+" is not stored as warm start"
+              + (" (at the edge of the scan range)" if at_edge else ""))
+
+    print("Mean settle time of the lens: "+str(np.mean(settle.settle_times))+"s")
+
+    return {"pos_x": int(pos_x), "pos_z": int(pos_z), "z_focus": z_focus, "n_frames_z": n_frames_z,
+            "x_edge": x_edge_pos, "x_edge_std": x_edge_std, "metric": float(metric), "valid": valid}
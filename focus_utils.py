@@ -0,0 +1,337 @@
+"""
+Focus surface of a sample holder, fitted to a few autofocused anchor positions
+
+Instead of autofocusing at every well, the focus is measured at a sparse set
+of anchor wells and a plane (order=1) or a low-order polynomial surface
+z(x, y) is fitted through them; every other position gets its Z from the
+model. Anchors are refocused one at a time (round robin); if the measured Z
+deviates from the model by more than the tolerance, all anchors are marked
+stale and refocused when they are visited next.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+# fitted focus surfaces per sample holder, see save_focus_surface
+focus_surface_file = os.path.join(os.path.expanduser("~"), ".uc2_focus_planes.json")
+
+
+def choose_anchors(positions, n_anchors=4):
+    """
+    Indices of n_anchors positions spread over the plate (farthest point sampling)
+
+    Starts with the position closest to the centre, so a single anchor gives a
+    sensible constant focus and more anchors span the corners.
+    """
+    positions = np.asarray(positions, dtype=float)
+    n_anchors = min(n_anchors, len(positions))
+    if n_anchors <= 0:
+        return []
+    anchors = [int(np.argmin(np.sum((positions - positions.mean(0))**2, 1)))]
+    distance = np.sum((positions - positions[anchors[0]])**2, 1)
+    while len(anchors) < n_anchors:
+        anchors.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, np.sum((positions - positions[anchors[-1]])**2, 1))
+    return anchors
+
+
+class FocusSurface(object):
+    """
+    Least-squares polynomial surface z(x, y) through the anchor positions
+
+    Args:
+        order (int): 0 = constant, 1 = plane (tilt), 2 = quadratic (bowing)
+        tolerance (float): residual (steps) above which the anchors are refocused
+        anchors (list): optional [x, y, z] anchor points, e.g. from a checkpoint
+    """
+
+    def __init__(self, order=1, tolerance=200., anchors=None):
+        self.order = order
+        self.tolerance = tolerance
+        self.anchors = {}
+        self.stale = set()
+        self.coefficients = None
+        self.n_refresh = 0
+        for x, y, z in anchors or []:
+            self.anchors[(x, y)] = z
+        self.fit()
+
+    def _terms(self, x, y, order):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        return np.stack([x**(i - j) * y**j for i in range(order + 1) for j in range(i + 1)], -1)
+
+    def _order(self):
+        # reduce the order if there are not enough anchors for the requested one
+        order = self.order
+        while order > 0 and len(self.anchors) < (order + 1) * (order + 2) // 2:
+            order -= 1
+        return order
+
+    def fit(self):
+        if not self.anchors:
+            self.coefficients = None
+            return None
+        xy = np.array(list(self.anchors.keys()), dtype=float)
+        z = np.array(list(self.anchors.values()), dtype=float)
+        # centre the coordinates to keep the least squares problem well conditioned
+        self.center = xy.mean(0)
+        self.fit_order = self._order()
+        terms = self._terms(xy[:, 0] - self.center[0], xy[:, 1] - self.center[1], self.fit_order)
+        self.coefficients = np.linalg.lstsq(terms, z, rcond=None)[0]
+        return self.coefficients
+
+    @property
+    def is_fitted(self):
+        return self.coefficients is not None
+
+    def predict(self, x, y):
+        """Focus position at (x, y)"""
+        terms = self._terms(np.asarray(x, dtype=float) - self.center[0],
+                            np.asarray(y, dtype=float) - self.center[1], self.fit_order)
+        return terms @ self.coefficients
+
+    def residuals(self):
+        """Measured minus modelled Z of every anchor"""
+        if not self.is_fitted:
+            return {}
+        return {xy: z - float(self.predict(*xy)) for xy, z in self.anchors.items()}
+
+    def add(self, x, y, z):
+        """
+        Set the measured focus z of the anchor at (x, y) and refit
+
+        Returns:
+            residual of the measurement against the previous model (None for
+            a new anchor)
+        """
+        residual = None
+        if self.is_fitted and (x, y) in self.anchors:
+            residual = z - float(self.predict(x, y))
+            if abs(residual) > self.tolerance:
+                # the plate moved or tilted: refocus all anchors on their next visit
+                logging.warning("Focus model off by %.0f steps at (%s, %s), refreshing all anchors",
+                                residual, x, y)
+                self.stale.update(self.anchors)
+        self.anchors[(x, y)] = z
+        self.stale.discard((x, y))
+        self.n_refresh += 1
+        self.fit()
+        return residual
+
+    def needs_refresh(self, x, y, k):
+        """
+        Should the anchor at (x, y) be refocused in scan k?
+
+        Anchors which were never focused or are stale always are, otherwise
+        one anchor per scan in turn.
+        """
+        if (x, y) not in self.anchors or (x, y) in self.stale:
+            return True
+        anchors = sorted(self.anchors)
+        return anchors.index((x, y)) == k % len(anchors)
+
+    def to_list(self):
+        """Anchor points as [x, y, z] (JSON serialisable)"""
+        return [[float(x), float(y), float(z)] for (x, y), z in self.anchors.items()]
+
+
+def load_focus_surface(holder="default", filename=focus_surface_file):
+    """The stored FocusSurface of a sample holder or None"""
+    try:
+        with open(filename) as f:
+            stored = json.load(f).get(holder)
+    except (OSError, ValueError):
+        return None
+    if not stored:
+        return None
+    return FocusSurface(order=stored["order"], anchors=stored["anchors"])
+
+
+def save_focus_surface(surface, holder="default", filename=focus_surface_file):
+    """Remember the focus surface of a sample holder"""
+    try:
+        with open(filename) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        stored = {}
+    residuals = surface.residuals()
+    stored[holder] = {
+        "order": surface.order,
+        "anchors": surface.to_list(),
+        "rms": float(np.sqrt(np.mean(np.square(list(residuals.values()))))) if residuals else None,
+        "time": time.time(),
+    }
+    with open(filename, "w") as f:
+        json.dump(stored, f, indent=2)
+
+
+def sharpness(frame, method="laplacian"):
+    """
+    Sharpness of a (low-res) frame: variance of the Laplacian or Brenner gradient
+
+    Both grow with the high spatial frequencies, i.e. they are largest in focus.
+    """
+    frame = np.asarray(frame, dtype=np.float32)
+    if frame.ndim == 3:
+        frame = frame.mean(-1)
+    if method == "brenner":
+        return float(np.mean((frame[:, 2:] - frame[:, :-2])**2))
+    laplacian = (frame[1:-1, :-2] + frame[1:-1, 2:] + frame[:-2, 1:-1] + frame[2:, 1:-1]
+                 - 4 * frame[1:-1, 1:-1])
+    return float(np.var(laplacian))
+
+
+class QualityGate(object):
+    """
+    Decide on a low-res frame whether a tile is worth keeping or needs a refocus
+
+    A tile without content (grey value standard deviation below min_contrast)
+    is "empty" and is not refocused - there is nothing to focus on. Otherwise
+    its sharpness is compared to the best sharpness seen at the same position
+    so far; below min_relative of that it is "blurred". On the first visit of
+    a position it is compared to the median of the references of the other
+    positions instead, so a blurred first frame doesn't become the reference;
+    the very first tile has nothing to compare to and is always refocused.
+    After a refocus the autofocus result is trusted as the reference of a new
+    position. Tiles below min_sharpness are always blurred.
+
+    Args:
+        method (str): "laplacian" or "brenner"
+        min_relative (float): fraction of the best sharpness of the position considered sharp
+        min_sharpness (float): absolute sharpness below which a tile is always blurred
+        min_contrast (float): grey value standard deviation below which a tile is empty
+    """
+
+    def __init__(self, method="laplacian", min_relative=.6, min_sharpness=0., min_contrast=3.):
+        self.method = method
+        self.min_relative = min_relative
+        self.min_sharpness = min_sharpness
+        self.min_contrast = min_contrast
+        self.reference = {}
+        self.n_checked = 0
+        self.n_failed = 0
+
+    def check(self, key, frame, refocused=False):
+        """
+        Scores of the frame at position key
+
+        Args:
+            key: position of the tile
+            frame (np.ndarray): low-res frame of the tile
+            refocused (bool): the frame was taken right after an autofocus
+
+        Returns:
+            dict with "sharpness", "contrast", "mean", the "reference" it was
+            compared to, "refocused" and "status" ("ok", "blurred" or "empty")
+        """
+        gray = np.asarray(frame, dtype=np.float32)
+        if gray.ndim == 3:
+            gray = gray.mean(-1)
+        scores = {
+            "sharpness": sharpness(gray, self.method),
+            "contrast": float(np.std(gray)),
+            "mean": float(np.mean(gray)),
+            "reference": self.reference.get(key),
+            "refocused": refocused,
+        }
+        if scores["reference"] is None and self.reference and not refocused:
+            # first visit: the typical sharpness of the positions seen so far
+            scores["reference"] = float(np.median(list(self.reference.values())))
+        if scores["contrast"] < self.min_contrast:
+            scores["status"] = "empty"
+        elif scores["sharpness"] < self.min_sharpness or (scores["reference"] is None and not refocused) or (
+                scores["reference"] is not None and scores["sharpness"] < self.min_relative * scores["reference"]):
+            scores["status"] = "blurred"
+        else:
+            scores["status"] = "ok"
+            self.reference[key] = max(scores["sharpness"], self.reference.get(key, 0.))
+        self.n_checked += 1
+        self.n_failed += scores["status"] != "ok"
+        return scores
+
+    def stats(self):
+        return {"n_checked": self.n_checked, "n_failed": self.n_failed}
+
+
+class DriftTracker(object):
+    """
+    Per-position Kalman filter of the focus position and its drift velocity
+
+    Thermal focus drift is smooth, so a constant velocity model extrapolates
+    the focus of every position from its past autofocus results. The
+    uncertainty of the prediction gives the autofocus window: once a
+    position has been measured a few times, a narrow (and short) z stack
+    around the prediction is enough.
+
+    Args:
+        measurement_noise (float): standard deviation (steps) of an autofocus result
+        position_noise (float): random focus change (steps) per sqrt(hour)
+        velocity_noise (float): random change of the drift (steps/hour) per sqrt(hour)
+        initial_velocity (float): prior standard deviation of the drift (steps/hour)
+        tracks (dict): optional state from to_dict(), e.g. from a checkpoint
+    """
+
+    def __init__(self, measurement_noise=50., position_noise=20., velocity_noise=100.,
+                 initial_velocity=1000., tracks=None):
+        self.r = measurement_noise**2
+        # convert to seconds
+        self.q_z = position_noise**2 / 3600.
+        self.q_v = (velocity_noise / 3600.)**2 / 3600.
+        self.p_v = (initial_velocity / 3600.)**2
+        self.tracks = {}
+        for key, track in (tracks or {}).items():
+            self.tracks[key] = {"t": track["t"], "x": np.array(track["x"]), "P": np.array(track["P"])}
+
+    def _predict(self, track, t):
+        dt = max(t - track["t"], 0.)
+        F = np.array([[1., dt], [0., 1.]])
+        Q = np.array([[self.q_z * dt + self.q_v * dt**3 / 3, self.q_v * dt**2 / 2],
+                      [self.q_v * dt**2 / 2, self.q_v * dt]])
+        return F @ track["x"], F @ track["P"] @ F.T + Q
+
+    def predict(self, key, t):
+        """Predicted focus and its standard deviation at time t (None, None if never measured)"""
+        track = self.tracks.get(key)
+        if track is None:
+            return None, None
+        x, P = self._predict(track, t)
+        return float(x[0]), float(np.sqrt(P[0, 0] + self.r))
+
+    def update(self, key, t, z):
+        """Add the autofocus result z measured at time t"""
+        track = self.tracks.get(key)
+        if track is None:
+            self.tracks[key] = {"t": t, "x": np.array([float(z), 0.]), "P": np.diag([self.r, self.p_v])}
+            return
+        x, P = self._predict(track, t)
+        # measure the focus position only
+        S = P[0, 0] + self.r
+        K = P[:, 0] / S
+        x = x + K * (z - x[0])
+        P = P - np.outer(K, P[0, :])
+        self.tracks[key] = {"t": t, "x": x, "P": P}
+
+    def window(self, key, t, z, autofocus_dz, autofocus_Nz, n_sigma=3., min_dz=200.):
+        """
+        Centre and range of the autofocus z stack at position key
+
+        Returns:
+            (z_center, dz, Nz): the predicted focus (or z if the position is new)
+            and a window of n_sigma standard deviations (between min_dz and
+            autofocus_dz) with the same step size as the full autofocus
+        """
+        z_pred, sigma = self.predict(key, t)
+        if z_pred is None:
+            return z, autofocus_dz, autofocus_Nz
+        dz = float(np.clip(n_sigma * sigma, min(min_dz, autofocus_dz), autofocus_dz))
+        step = 2. * autofocus_dz / max(autofocus_Nz - 1, 1)
+        Nz = int(min(autofocus_Nz, max(5, np.ceil(2 * dz / step) + 1)))
+        return int(round(z_pred)), dz, Nz
+
+    def to_dict(self):
+        """State of all tracks (JSON serialisable with string keys)"""
+        return {key: {"t": track["t"], "x": track["x"].tolist(), "P": track["P"].tolist()}
+                for key, track in self.tracks.items()}
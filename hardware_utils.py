@@ -0,0 +1,155 @@
+"""
+Process-wide serial connections to the ESP32 boards driving lens and laser
+
+Opening a serial port resets the ESP32, so the connection and the device
+objects built on top of it (lens, laser, ...) are kept alive between actions
+and shared by all extensions. Access is serialised with a lock per port,
+the port is reopened if a command fails and every command is timed.
+"""
+import threading
+import time
+import logging
+
+import serial
+
+from timing_utils import timer
+
+# open connections, one per serial port
+connections = {}
+connections_lock = threading.Lock()
+
+
+class DeviceProxy(object):
+    """Forward method calls to a device through its (locked, timed) connection"""
+
+    def __init__(self, connection, name):
+        self._connection = connection
+        self._name = name
+
+    def __getattr__(self, attr):
+        target = getattr(self._connection.devices[self._name], attr)
+        if not callable(target):
+            return target
+
+        def call(*args, **kwargs):
+            return self._connection.call(self._name, attr, *args, **kwargs)
+        return call
+
+
+class SerialConnection(object):
+    """
+    A serial port together with the device objects which talk through it
+
+    Args:
+        port (str): serial port, e.g. /dev/ttyUSB0
+        baudrate (int): baudrate of the ESP32
+        timeout (float): read timeout of the serial port
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=1):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial = None
+        self.lock = threading.RLock()
+        self.devices = {}
+        self.device_factories = {}
+        self.timings = {}
+        self.n_reconnects = 0
+
+    def connect(self):
+        with self.lock:
+            t_start = time.time()
+            self.serial = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
+            # (re)build all devices on top of the new connection
+            for name, (cls, kwargs) in self.device_factories.items():
+                self.devices[name] = cls(self.serial, **kwargs)
+            self._record("connect", time.time() - t_start)
+            logging.info("Connected to %s", self.port)
+
+    def close(self):
+        with self.lock:
+            if self.serial is not None:
+                try:
+                    self.serial.close()
+                except (serial.SerialException, OSError):
+                    pass
+            self.serial = None
+
+    @property
+    def is_open(self):
+        return self.serial is not None and self.serial.is_open
+
+    def device(self, name, cls, **kwargs):
+        """
+        Return the device called name, creating cls(serialconnection, **kwargs) once
+
+        The returned proxy can be used like the device itself.
+        """
+        with self.lock:
+            if name not in self.device_factories:
+                self.device_factories[name] = (cls, kwargs)
+                if self.is_open:
+                    self.devices[name] = cls(self.serial, **kwargs)
+            if not self.is_open:
+                self.connect()
+        return DeviceProxy(self, name)
+
+    def call(self, name, method, *args, **kwargs):
+        """Call a device method under the lock; reconnect and retry once on a serial error"""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if not self.is_open:
+                        self.n_reconnects += 1
+                        self.connect()
+                    t_start = time.time()
+                    result = getattr(self.devices[name], method)(*args, **kwargs)
+                except (serial.SerialException, OSError) as e:
+                    logging.warning("Serial error on %s (%s), reconnecting", self.port, e)
+                    self.close()
+                    if attempt:
+                        raise
+                    continue
+                self._record(name + "." + method, time.time() - t_start)
+                return result
+
+    def _record(self, command, duration):
+        timer.record(command, time.time() - duration, duration, port=self.port)
+        timing = self.timings.setdefault(command, {"n": 0, "total": 0., "max": 0.})
+        timing["n"] += 1
+        timing["total"] += duration
+        timing["max"] = max(timing["max"], duration)
+
+    def stats(self):
+        """Number of calls, mean and max duration (s) per command"""
+        with self.lock:
+            return {
+                "port": self.port,
+                "open": self.is_open,
+                "n_reconnects": self.n_reconnects,
+                "commands": {
+                    command: {"n": t["n"], "mean": t["total"] / t["n"], "max": t["max"]}
+                    for command, t in self.timings.items()
+                },
+            }
+
+
+def get_serial_connection(port, baudrate=115200, timeout=1):
+    """Return the shared connection for port, opening it on first use"""
+    with connections_lock:
+        if port not in connections:
+            connections[port] = SerialConnection(port, baudrate, timeout)
+        return connections[port]
+
+
+def serial_stats():
+    with connections_lock:
+        return [connection.stats() for connection in connections.values()]
+
+
+def close_all():
+    with connections_lock:
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
@@ -15,13 +15,16 @@ from openflexure_microscope.captures.capture_manager import (
     generate_basename,
 )
 
+from timing_utils import timer
+
 # Used to convert our GUI dictionary into a complete eV extension GUI
 from openflexure_microscope.api.utilities.gui import build_gui
 
 ## Extension methods
 def control_laser(microscope, i_laser=0, i_led=0):
-    microscope.stage.set_led(state=int(i_led))
-    microscope.stage.set_laser_intensity(int(i_laser))
+    with timer.span("illumination", laser=int(i_laser), led=int(i_led)):
+        microscope.stage.set_led(state=int(i_led))
+        microscope.stage.set_laser_intensity(int(i_laser))
 
 
  
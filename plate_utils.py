@@ -0,0 +1,561 @@
+"""
+Planning of the order in which a set of stage positions (wells, tiles) is visited
+
+    positions, labels = grid_positions(offset_x, offset_y, nx=12, ny=8, pitch=9000)
+    plan = plan_path(positions, method="tsp", start=microscope.stage.position)
+    for i in plan["order"]:
+        microscope.stage.move_abs(positions[i])
+
+The cost of a move is the predicted travel time: the axes move at the same
+time, so a move takes as long as its slowest axis plus a constant overhead
+(serial round trip, acceleration). Z can be included so that positions with
+similar focus are visited one after the other. The speeds are measured on
+the stage with measure_stage_speeds() and remembered in stage_speed_file.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+stage_speed_file = os.path.join(os.path.expanduser("~"), ".uc2_stage_speeds.json")
+
+# used until the stage has been measured: steps/s per axis and seconds per move
+default_speeds = {"speed": [2000., 2000., 500.], "overhead": .2}
+
+
+def grid_positions(offset_x, offset_y, nx, ny, pitch_x, pitch_y=None):
+    """
+    Absolute (x, y) positions of a regular nx * ny grid (e.g. wells of a plate)
+
+    Returns:
+        positions (np.ndarray): (nx * ny, 2) positions, row by row
+        labels (list): (ix, iy) grid index of every position
+    """
+    pitch_y = pitch_x if pitch_y is None else pitch_y
+    labels = [(ix, iy) for iy in range(int(ny)) for ix in range(int(nx))]
+    positions = np.array([(offset_x + pitch_x * ix, offset_y + pitch_y * iy) for ix, iy in labels], dtype=float)
+    return positions.reshape(-1, 2), labels
+
+
+def load_stage_speeds(filename=stage_speed_file):
+    """Measured stage speeds, or the defaults if the stage was never measured"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict(default_speeds)
+
+
+def save_stage_speeds(speeds, filename=stage_speed_file):
+    with open(filename, "w") as f:
+        json.dump(speeds, f, indent=2)
+
+
+def measure_stage_speeds(stage, distance=(5000, 5000, 1000), filename=stage_speed_file):
+    """
+    Time back and forth moves of every axis to calibrate the travel time model
+
+    A move of one step gives the overhead, the long moves the speed per axis.
+
+    Args:
+        stage: stage with move_rel((dx, dy, dz))
+        distance (tuple): length (steps) of the test move per axis
+        filename (str): where the speeds are remembered (None: don't save)
+    """
+    def timed_move(delta):
+        t_start = time.time()
+        stage.move_rel(delta)
+        return time.time() - t_start
+
+    overhead = np.mean([timed_move((1, 0, 0)), timed_move((-1, 0, 0))])
+    speed = []
+    for axis, d in enumerate(distance):
+        delta = np.zeros(3, int)
+        delta[axis] = d
+        duration = (timed_move(tuple(delta)) + timed_move(tuple(-delta))) / 2
+        speed.append(float(d / max(duration - overhead, 1e-3)))
+    speeds = {"speed": speed, "overhead": float(overhead), "time": time.time()}
+    if filename is not None:
+        save_stage_speeds(speeds, filename)
+    return speeds
+
+
+def travel_time(start, end, speeds=None):
+    """
+    Predicted time (s) of the moves start -> end
+
+    start and end are (..., 2) or (..., 3) arrays of positions (x, y[, z]).
+    """
+    speeds = speeds or default_speeds
+    delta = np.abs(np.asarray(end, dtype=float) - np.asarray(start, dtype=float))
+    speed = np.asarray(speeds["speed"][:delta.shape[-1]], dtype=float)
+    duration = np.max(delta / speed, -1)
+    return np.where(np.any(delta > 0, -1), duration + speeds["overhead"], 0.)
+
+
+def _cost_matrix(points, speeds):
+    return travel_time(points[:, np.newaxis], points[np.newaxis, :], speeds)
+
+
+def path_time(points, order, start=None, speeds=None):
+    """Predicted time (s) to visit points in order (starting at start)"""
+    points = np.asarray(points, dtype=float)[list(order)]
+    if start is not None:
+        points = np.concatenate((np.asarray(start, dtype=float)[np.newaxis, :points.shape[1]], points))
+    if len(points) < 2:
+        return 0.
+    return float(np.sum(travel_time(points[:-1], points[1:], speeds)))
+
+
+def serpentine_order(positions, row_tolerance=None):
+    """
+    Visit the positions row by row (along X), reversing the direction every other row
+
+    Positions whose Y differ by less than row_tolerance (default: half of the
+    smallest Y spacing) are in the same row.
+    """
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) == 0:
+        return []
+    y = positions[:, 1]
+    if row_tolerance is None:
+        dy = np.diff(np.unique(y))
+        row_tolerance = dy.min() / 2 if len(dy) else 1.
+    rows = np.round((y - y.min()) / (2 * row_tolerance)).astype(int)
+    order = []
+    for i_row, row in enumerate(np.unique(rows)):
+        members = np.where(rows == row)[0]
+        members = members[np.argsort(positions[members, 0], kind="stable")]
+        order.extend(members[::-1] if i_row % 2 else members)
+    return [int(i) for i in order]
+
+
+def tsp_order(points, start=None, speeds=None, n_iter=20):
+    """
+    Short (in time) open path through all points: nearest neighbour tour improved by 2-opt
+
+    Args:
+        points (np.ndarray): (N, 2) or (N, 3) positions
+        start: position of the stage before the first move (optional)
+        n_iter (int): maximum number of 2-opt passes
+    """
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n < 2:
+        return list(range(n))
+    cost = _cost_matrix(points, speeds)
+    if start is not None:
+        start_cost = travel_time(np.asarray(start, dtype=float)[:points.shape[1]], points, speeds)
+    else:
+        start_cost = np.zeros(n)
+
+    # nearest neighbour
+    order = [int(np.argmin(start_cost))]
+    visited = np.zeros(n, bool)
+    visited[order[0]] = True
+    for _ in range(n - 1):
+        c = np.where(visited, np.inf, cost[order[-1]])
+        order.append(int(np.argmin(c)))
+        visited[order[-1]] = True
+
+    # 2-opt: reverse segments as long as that shortens the path
+    order = np.array(order)
+    for _ in range(n_iter):
+        improved = False
+        for i in range(n - 1):
+            before = start_cost[order[i]] if i == 0 else cost[order[i - 1], order[i]]
+            for j in range(i + 1, n):
+                after = 0. if j == n - 1 else cost[order[j], order[j + 1]]
+                new_before = start_cost[order[j]] if i == 0 else cost[order[i - 1], order[j]]
+                new_after = 0. if j == n - 1 else cost[order[i], order[j + 1]]
+                if new_before + new_after < before + after - 1e-9:
+                    order[i:j + 1] = order[i:j + 1][::-1].copy()
+                    before = new_before
+                    improved = True
+        if not improved:
+            break
+    return [int(i) for i in order]
+
+
+def spiral_offsets(step, radius):
+    """
+    (dx, dy) of an outward square spiral: the start, then ring by ring up to radius
+
+        (0, 0), (step, 0), (step, step), (0, step), (-step, step), (-step, 0), ...
+    """
+    yield 0, 0
+    x, y = 0, 0
+    directions = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    i_leg = 0
+    while True:
+        dx, dy = directions[i_leg % 4]
+        for _ in range(i_leg // 2 + 1):
+            x, y = x + dx, y + dy
+            if max(abs(x), abs(y)) * step > radius:
+                return
+            yield x * step, y * step
+        i_leg += 1
+
+
+def search_sample(move, probe, start, dark, step=1000, radius=10000, min_delta=20., n_confirm=3, bounds=None):
+    """
+    Search the sample along an outward square spiral around start
+
+    At every position a fast low-res probe (e.g. the mean grey value) is
+    compared to the dark baseline; a position whose probe exceeds it by more
+    than min_delta is a candidate. The search stops as soon as n_confirm
+    consecutive positions are candidates, i.e. the sample is really there
+    and not just a speck of dust, and moves to the best of them. If nothing
+    is confirmed within radius, it returns to the start.
+
+    The baseline has to be measured beforehand on an empty position: a
+    baseline taken from the probes themselves is the sample if the spiral
+    starts on it. Positions outside bounds (e.g. behind the end stops next
+    to the homed origin) are not probed and interrupt a run of candidates.
+
+    Args:
+        move (callable): move(x, y) to an absolute position
+        probe (callable): probe() returns the metric at the current position
+        start (tuple): (x, y) centre of the spiral
+        dark (float): probe of an empty position
+        step (float): distance between two probes
+        radius (float): maximum distance from start
+        min_delta (float): probe - dark above which a position is a candidate
+        n_confirm (int): number of consecutive candidates needed
+        bounds (tuple): ((x_min, x_max), (y_min, y_max)) reachable positions, None for no limit
+
+    Returns:
+        dict with "found", the final "position", all "candidates" [(x, y, score)],
+        the "scores" of every probed position and "n_probes"
+    """
+    if dark is None:
+        raise ValueError("search_sample needs the probe of an empty position (dark)")
+    bounds = bounds or ((None, None), (None, None))
+
+    def reachable(x, y):
+        return all((low is None or p >= low) and (high is None or p <= high)
+                   for p, (low, high) in zip((x, y), bounds))
+
+    scores = []
+    candidates = []
+    run = []
+    for dx, dy in spiral_offsets(step, radius):
+        x, y = start[0] + dx, start[1] + dy
+        if not reachable(x, y):
+            # the confirmations have to be neighbours on the spiral
+            run = []
+            continue
+        if dx or dy:
+            move(x, y)
+        score = float(probe()) - dark
+        scores.append((x, y, score))
+        if score > min_delta:
+            candidates.append((x, y, score))
+            run.append((x, y, score))
+            if len(run) >= n_confirm:
+                x, y, _ = max(run, key=lambda c: c[2])
+                move(x, y)
+                return {"found": True, "position": (x, y), "candidates": candidates,
+                        "scores": scores, "n_probes": len(scores)}
+        else:
+            run = []
+    move(*start[:2])
+    return {"found": False, "position": tuple(start[:2]), "candidates": candidates,
+            "scores": scores, "n_probes": len(scores)}
+
+
+def plan_path(positions, method="serpentine", start=None, z=None, speeds=None):
+    """
+    Order in which to visit positions, with the predicted travel time
+
+    Args:
+        positions (np.ndarray): (N, 2) absolute (x, y) target positions
+        method (str): "raster" (as given), "serpentine" or "tsp"
+        start: current stage position (x, y[, z]), used for the first move
+        z (np.ndarray): optional focus of every position, so that Z changes are minimised too
+        speeds (dict): stage speeds (default: the measured ones, see load_stage_speeds)
+
+    Returns:
+        dict with the "order" (indices into positions), the ordered absolute
+        "positions" (x, y[, z]) and the predicted "travel_time" (s)
+    """
+    speeds = speeds or load_stage_speeds()
+    points = np.asarray(positions, dtype=float).reshape(-1, 2)
+    if z is not None:
+        points = np.concatenate((points, np.asarray(z, dtype=float).reshape(-1, 1)), 1)
+    if start is not None:
+        start = np.asarray(start, dtype=float)[:points.shape[1]]
+        if len(start) < points.shape[1]:
+            start = None
+
+    if method == "tsp":
+        order = tsp_order(points, start, speeds)
+    else:
+        order = serpentine_order(points[:, :2]) if method == "serpentine" else list(range(len(points)))
+        # e.g. in a repeated scan, start at the end where the last scan stopped
+        if start is not None and path_time(points, order[::-1], start, speeds) < path_time(points, order, start, speeds):
+            order = order[::-1]
+
+    return {
+        "order": order,
+        "positions": points[order],
+        "travel_time": path_time(points, order, start, speeds),
+    }
+
+
+plate_map_file = os.path.join(os.path.expanduser("~"), ".uc2_platemap.json")
+plate_rows = "ABCDEFGHIJKLMNOP"
+
+# nominal stage position (x, y) of A1 on the holder: the SBS 96 well plate has the centre of A1
+# 11.24 mm (rows, along X) and 14.38 mm (columns, along Y) from its corner, which the holder puts
+# at the homed origin; 1000 steps/mm as for the 9 mm (9000 steps) well pitch
+nominal_first_well = (11240, 14380)
+
+
+def well_name(row, col):
+    """Name of the well in row/column (0-based), e.g. (1, 2) -> "B3" """
+    return plate_rows[row] + str(col + 1)
+
+
+def parse_well(name, n_rows=8, n_cols=12):
+    """(row, col), 0-based, of a well name like "B3"; ValueError if it is not on the plate"""
+    name = name.strip().upper()
+    if len(name) < 2 or name[0] not in plate_rows[:n_rows] or not name[1:].isdigit() \
+            or not 1 <= int(name[1:]) <= n_cols:
+        raise ValueError("Invalid well "+repr(name)+", expected A1.."+plate_rows[n_rows - 1]+str(n_cols))
+    return plate_rows.index(name[0]), int(name[1:]) - 1
+
+
+def parse_wells(wells, n_rows=8, n_cols=12):
+    """
+    Wells selected by a string: "all", a list "A1,B3,H12" or rectangles "A1:B6"
+
+    Returns:
+        list of (row, col), 0-based, in plate order; ValueError for wells not on the plate
+    """
+    if wells is None or str(wells).strip().lower() in ("", "all"):
+        return [(row, col) for row in range(n_rows) for col in range(n_cols)]
+    selected = []
+    for part in str(wells).split(","):
+        if ":" in part:
+            corners = part.split(":")
+            if len(corners) != 2:
+                raise ValueError("Invalid well range "+repr(part.strip())+", expected e.g. A1:B6")
+            (r0, c0), (r1, c1) = [parse_well(w, n_rows, n_cols) for w in corners]
+            selected += [(row, col) for row in range(min(r0, r1), max(r0, r1) + 1)
+                         for col in range(min(c0, c1), max(c0, c1) + 1)]
+        elif part.strip():
+            selected.append(parse_well(part, n_rows, n_cols))
+    return sorted(set(selected))
+
+
+class PlateMap(object):
+    """
+    Affine map from plate coordinates (row, col) to stage steps (x, y)
+
+        [x, y] = matrix @ [row, col] + offset
+
+    The matrix includes the pitch, a rotation of the plate and a skew of
+    the stage axes. Until three or more well centres are registered, the
+    nominal pitch is used and only the offset (and with two wells the
+    rotation and scale) is fitted.
+
+    Args:
+        pitch (float): nominal well to well distance (steps)
+        origin (tuple): stage position of the first well A1
+        matrix: nominal (2, 2) matrix; the default has the rows along X and the columns along Y
+    """
+
+    def __init__(self, pitch=9000., origin=(0., 0.), matrix=None):
+        self.nominal = np.array(matrix if matrix is not None else [[pitch, 0.], [0., pitch]], dtype=float)
+        self.matrix = self.nominal.copy()
+        self.offset = np.array(origin[:2], dtype=float)
+        self.wells = {}
+
+    def position(self, row, col):
+        """Stage position (x, y) of the centre of the well in row/column (0-based)"""
+        return self.matrix @ np.array([row, col], dtype=float) + self.offset
+
+    def add(self, row, col, x, y):
+        """Register the measured centre of a well and refit"""
+        self.wells[(row, col)] = (float(x), float(y))
+        self.fit()
+
+    def fit(self):
+        plate = np.array(list(self.wells.keys()), dtype=float)
+        stage = np.array(list(self.wells.values()), dtype=float)
+        if len(plate) == 0:
+            return
+        if len(plate) >= 3 and np.linalg.matrix_rank(plate - plate.mean(0)) == 2:
+            # full affine transform
+            terms = np.concatenate((plate, np.ones((len(plate), 1))), 1)
+            solution = np.linalg.lstsq(terms, stage, rcond=None)[0]
+            self.matrix, self.offset = solution[:2].T, solution[2]
+        elif len(plate) >= 2:
+            # rotation and scale of the nominal matrix from the two most distant wells
+            i, j = np.unravel_index(np.argmax(np.sum((plate[:, None] - plate[None]) ** 2, -1)), (len(plate),) * 2)
+            nominal = self.nominal @ (plate[j] - plate[i])
+            measured = stage[j] - stage[i]
+            angle = np.arctan2(measured[1], measured[0]) - np.arctan2(nominal[1], nominal[0])
+            scale = np.linalg.norm(measured) / np.linalg.norm(nominal)
+            rotation = scale * np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+            self.matrix = rotation @ self.nominal
+            self.offset = np.mean(stage - plate @ self.matrix.T, 0)
+        else:
+            self.matrix = self.nominal.copy()
+            self.offset = stage[0] - self.matrix @ plate[0]
+
+    def residuals(self):
+        """Distance (steps) between the measured and the mapped centre of every registered well"""
+        return {well_name(*well): float(np.linalg.norm(self.position(*well) - np.array(xy)))
+                for well, xy in self.wells.items()}
+
+    def to_dict(self):
+        return {"matrix": self.matrix.tolist(), "offset": self.offset.tolist(), "nominal": self.nominal.tolist(),
+                "wells": {well_name(*well): xy for well, xy in self.wells.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        plate_map = cls(matrix=data["nominal"])
+        plate_map.matrix = np.array(data["matrix"])
+        plate_map.offset = np.array(data["offset"])
+        plate_map.wells = {parse_well(name): tuple(xy) for name, xy in data.get("wells", {}).items()}
+        return plate_map
+
+    def save(self, filename=plate_map_file):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    @classmethod
+    def load(cls, filename=plate_map_file):
+        """The last registered plate map or None"""
+        try:
+            with open(filename) as f:
+                return cls.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def image_shift(frame_a, frame_b):
+    """
+    Displacement (rows, cols) in pixels of the content of frame_b relative to frame_a
+
+    Phase correlation of the two (grayscale) frames; precise to a pixel.
+    """
+    a = np.asarray(frame_a, dtype=np.float32)
+    b = np.asarray(frame_b, dtype=np.float32)
+    cross = np.fft.fft2(b - b.mean()) * np.conj(np.fft.fft2(a - a.mean()))
+    correlation = np.abs(np.fft.ifft2(cross / (np.abs(cross) + 1e-9)))
+    shift = np.array(np.unravel_index(np.argmax(correlation), correlation.shape), dtype=float)
+    # shifts larger than half the frame are negative
+    size = np.array(correlation.shape)
+    shift[shift > size / 2] -= size[shift > size / 2]
+    return shift
+
+
+def pixel_to_steps(shift_x, shift_y, distance):
+    """
+    Matrix converting an image displacement (rows, cols) into stage steps (x, y)
+
+    Args:
+        shift_x, shift_y: image_shift() measured after moving the stage by distance in X and in Y
+        distance (float): length of the two test moves
+    """
+    shifts = np.stack([shift_x, shift_y], 1)
+    return distance * np.linalg.inv(shifts)
+
+
+def well_offset(frame, downsample=2):
+    """
+    Offset (rows, cols) in pixels of the centre of a bright well from the frame centre
+
+    The well is the part of the frame brighter than halfway between the
+    darkest and the brightest grey value; its centroid is the centre.
+
+    Returns:
+        offset (np.ndarray), fill (fraction of the frame covered by the well)
+    """
+    frame = np.asarray(frame, dtype=np.float32)[::downsample, ::downsample]
+    if frame.ndim == 3:
+        frame = frame.mean(-1)
+    mask = frame > (frame.min() + frame.max()) / 2
+    fill = float(mask.mean())
+    if not mask.any():
+        return np.zeros(2), 0.
+    rows, cols = np.nonzero(mask)
+    centre = (np.array(frame.shape) - 1) / 2
+    return (np.array([rows.mean(), cols.mean()]) - centre) * downsample, fill
+
+
+def well_statistics(frame):
+    """Cheap intensity and texture statistics of a low-res frame of a well"""
+    frame = np.asarray(frame, dtype=np.float32)
+    if frame.ndim == 3:
+        frame = frame.mean(-1)
+    return {
+        "mean": float(np.mean(frame)),
+        "contrast": float(np.std(frame)),
+        # Brenner gradient on every other pixel; still responds to slightly defocused content
+        "texture": float(np.mean((frame[::2, 2::2] - frame[::2, :-2:2])**2)),
+    }
+
+
+def classify_occupancy(statistics, min_ratio=2., min_separation=4., empty=None, empty_ratio=2.,
+                       empty_delta=20., n_mad=5.):
+    """
+    Split wells into occupied and empty from their well_statistics
+
+    Skipping a well loses its data, so a well is only empty if the evidence
+    is clear; when in doubt it is kept:
+
+    - The log texture of all wells is split into two groups at the threshold
+      with the smallest within-group variance (Otsu). The less textured group
+      is empty only if the plate is clearly bimodal: the group means differ by
+      at least min_ratio and by min_separation times the spread within the
+      groups. A unimodal plate (all occupied, or all empty) is split anyway by
+      Otsu, but its groups overlap and everything is kept.
+    - With an empty reference (well_statistics of a position known to be empty
+      or dark), wells which match it in texture and brightness are empty.
+    - Wells whose mean brightness is an outlier (e.g. a dark colony blocking
+      the light) are always occupied.
+
+    Args:
+        statistics (dict): well name -> well_statistics
+        min_ratio (float): minimum texture ratio between the occupied and the empty group
+        min_separation (float): minimum distance of the group means in within-group standard deviations
+        empty (dict): optional well_statistics of an empty reference
+        empty_ratio (float): texture up to this multiple of the reference matches it
+        empty_delta (float): brightness difference (grey values) up to which a well matches the reference
+        n_mad (float): brightness deviations (in median absolute deviations) counted as content
+
+    Returns:
+        dict well name -> True (occupied) / False (empty)
+    """
+    names = list(statistics)
+    if not names:
+        return {}
+    texture = np.log(np.array([statistics[n]["texture"] for n in names]) + 1e-3)
+    occupied = np.ones(len(names), bool)
+
+    order = np.sort(texture)
+    best = None
+    for i in range(1, len(order)):
+        low, high = order[:i], order[i:]
+        spread = len(low) * np.var(low) + len(high) * np.var(high)
+        if best is None or spread < best:
+            best, threshold = spread, (order[i - 1] + order[i]) / 2
+            gap = np.mean(high) - np.mean(low)
+            within = np.sqrt(spread / len(order))
+    if best is not None and gap >= np.log(min_ratio) and gap >= min_separation * max(within, 1e-3):
+        occupied = texture > threshold
+
+    mean = np.array([statistics[n]["mean"] for n in names])
+    if empty is not None:
+        matches = ((texture <= np.log(empty["texture"] * empty_ratio + 1e-3))
+                   & (np.abs(mean - empty["mean"]) <= empty_delta))
+        occupied &= ~matches
+
+    mad = np.median(np.abs(mean - np.median(mean))) + 1e-3
+    occupied |= np.abs(mean - np.median(mean)) > n_mad * mad
+    return {name: bool(o) for name, o in zip(names, occupied)}
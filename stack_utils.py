@@ -0,0 +1,237 @@
+"""
+Chunked frame storage for timelapse and scan series
+
+Instead of one image file per timepoint, modality and position, frames are
+appended to a few large chunk files which are read back with seek / memory maps:
+
+    stack_dir/
+        stack.json          format, shape, dtype, chunk bytes, position and modality names
+        chunk_00000.bin     payloads of the frames, one after the other
+        index_00000.npy     (time, position, modality, slot, timestamp, offset, length) of every frame in the chunk
+        info_00000.jsonl    filename, tags and metadata (stage position, quality, ...) per slot
+        ...
+
+A frame is either stored as its encoded bytes (e.g. the JPEG of a capture,
+decoded when it is read) or as a raw array. Chunk files are not preallocated;
+a new chunk is started once a chunk holds chunk_bytes, so the number of frames
+per chunk follows from the frame size.
+
+The frame data and its info are always written before the (atomically
+replaced) index of its chunk, so a FrameStack opened read-only can be refreshed and sliced
+while the acquisition is still recording:
+
+    stack = FrameStack(path, mode="r")
+    times, frames = stack.series(position="A1", modality="Brightfield")
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+try:
+    import cv2
+except:
+    print("CV2 is missing..encoded frames of a FrameStack can't be decoded")
+
+index_dtype = np.dtype([
+    ("t", np.int32),
+    ("position", np.int32),
+    ("modality", np.int32),
+    ("slot", np.int32),
+    ("timestamp", np.float64),
+    ("offset", np.int64),
+    ("length", np.int64),
+])
+
+
+def _save_atomic(filename, save):
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        save(f)
+    os.replace(tmp, filename)
+
+
+class FrameStack(object):
+    """
+    Append-only frame container indexed by (time, position, modality)
+
+    Args:
+        path (str): directory of the stack (created if needed in mode "a")
+        chunk_bytes (int): size (bytes) after which a new chunk file is started
+        mode (str): "a" to append (and read), "r" to only read
+    """
+
+    def __init__(self, path, chunk_bytes=256 * 2**20, mode="a"):
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.meta = {"format": None, "shape": None, "dtype": None, "chunk_bytes": chunk_bytes,
+                     "positions": [], "modalities": []}
+        self.indexes = {}
+        self.n_frames = 0
+        if mode == "a":
+            os.makedirs(path, exist_ok=True)
+        self.refresh()
+
+    def _file(self, name, i_chunk, extension=".npy"):
+        return os.path.join(self.path, "%s_%05d%s" % (name, i_chunk, extension))
+
+    def refresh(self):
+        """Reload the stack description and the indexes written so far"""
+        meta_file = os.path.join(self.path, "stack.json")
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.meta = json.load(f)
+        i_chunk = 0
+        self.n_frames = 0
+        while os.path.exists(self._file("index", i_chunk)):
+            # only the index of the last chunk still changes
+            index = self.indexes.get(i_chunk)
+            if index is None or not os.path.exists(self._file("index", i_chunk + 1)):
+                index = np.load(self._file("index", i_chunk))
+                self.indexes[i_chunk] = index
+            self.n_frames += len(index)
+            i_chunk += 1
+        return self.n_frames
+
+    def __len__(self):
+        return self.n_frames
+
+    def _save_meta(self):
+        _save_atomic(os.path.join(self.path, "stack.json"),
+                     lambda f: f.write(json.dumps(self.meta, indent=2).encode()))
+
+    def _name_index(self, kind, name):
+        names = self.meta[kind]
+        if name not in names:
+            names.append(name)
+            self._save_meta()
+        return names.index(name)
+
+    def _read(self, entry):
+        filename = self._file("chunk", int(entry["chunk"]), ".bin")
+        if self.meta["format"] == "raw":
+            return np.memmap(filename, dtype=self.meta["dtype"], mode="r",
+                             offset=int(entry["offset"]), shape=tuple(self.meta["shape"]))
+        with open(filename, "rb") as f:
+            f.seek(int(entry["offset"]))
+            data = f.read(int(entry["length"]))
+        if self.meta["format"] == "encoded":
+            return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return data
+
+    def append(self, frame, t, position=0, modality=0, timestamp=None, info=None):
+        """
+        Append a frame taken at timepoint t, position and modality (names or numbers)
+
+        frame is either the encoded image (bytes, e.g. a JPEG) or a raw array;
+        all frames of a stack have to be of the same kind (and raw frames of
+        the same shape). info is an optional JSON serialisable dict (e.g.
+        filename, tags and metadata of the capture) stored next to the frame, see info().
+        """
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            kind, data = "encoded", bytes(frame)
+        else:
+            frame = np.ascontiguousarray(frame)
+            kind, data = "raw", frame.tobytes()
+        with self.lock:
+            if self.meta["format"] is None:
+                self.meta["format"] = kind
+                if kind == "raw":
+                    self.meta["shape"] = list(frame.shape)
+                    self.meta["dtype"] = frame.dtype.str
+                self._save_meta()
+            elif kind != self.meta["format"]:
+                raise ValueError("Can't append "+kind+" frames to a stack of "+self.meta["format"]+" frames")
+            elif kind == "raw" and list(frame.shape) != self.meta["shape"]:
+                raise ValueError("Frame shape "+str(frame.shape)+" doesn't match the stack "+str(self.meta["shape"]))
+
+            # continue the last chunk until it holds chunk_bytes
+            i_chunk = max(self.indexes) if self.indexes else 0
+            index = self.indexes.get(i_chunk, np.empty(0, index_dtype))
+            offset = int(index["offset"][-1] + index["length"][-1]) if len(index) else 0
+            if len(index) and offset + len(data) > self.meta["chunk_bytes"]:
+                i_chunk, index, offset = i_chunk + 1, np.empty(0, index_dtype), 0
+            slot = len(index)
+
+            with open(self._file("chunk", i_chunk, ".bin"), "r+b" if offset else "wb") as f:
+                # drop what an interrupted append may have left behind
+                f.seek(offset)
+                f.truncate()
+                f.write(data)
+            if info is not None:
+                with open(self._file("info", i_chunk, ".jsonl"), "a") as f:
+                    f.write(json.dumps(dict(info, slot=slot), default=str) + "\n")
+
+            entry = np.array([(t, self._name_index("positions", position),
+                               self._name_index("modalities", modality), slot,
+                               time.time() if timestamp is None else timestamp,
+                               offset, len(data))], dtype=index_dtype)
+            index = np.concatenate((index, entry))
+            _save_atomic(self._file("index", i_chunk), lambda f: np.save(f, index))
+            self.indexes[i_chunk] = index
+            self.n_frames += 1
+
+    def index(self):
+        """Index of all frames with an additional "chunk" column"""
+        entries = []
+        for i_chunk in sorted(self.indexes):
+            index = self.indexes[i_chunk]
+            entries.append(np.rec.fromarrays(
+                [index[name] for name in index_dtype.names] + [np.full(len(index), i_chunk, np.int32)],
+                names=list(index_dtype.names) + ["chunk"]))
+        return np.concatenate(entries) if entries else np.empty(0)
+
+    def _select(self, position=None, modality=None, t=None):
+        index = self.index()
+        if len(index) == 0:
+            return index
+        mask = np.ones(len(index), bool)
+        if position is not None:
+            if position not in self.meta["positions"]:
+                return index[:0]
+            mask &= index["position"] == self.meta["positions"].index(position)
+        if modality is not None:
+            if modality not in self.meta["modalities"]:
+                return index[:0]
+            mask &= index["modality"] == self.meta["modalities"].index(modality)
+        if t is not None:
+            mask &= index["t"] == t
+        return index[mask]
+
+    def get(self, t, position=0, modality=0):
+        """Frame at timepoint t, position and modality (decoded, or memory-mapped if raw)"""
+        entries = self._select(position, modality, t)
+        if len(entries) == 0:
+            raise KeyError((t, position, modality))
+        return self._read(entries[-1])
+
+    def info(self, t, position=0, modality=0):
+        """Info dict stored with the frame at timepoint t, position and modality (None if there is none)"""
+        entries = self._select(position, modality, t)
+        if len(entries) == 0:
+            raise KeyError((t, position, modality))
+        entry = entries[-1]
+        filename = self._file("info", int(entry["chunk"]), ".jsonl")
+        if not os.path.exists(filename):
+            return None
+        info = None
+        with open(filename) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    # a line that is still being written
+                    continue
+                if item.get("slot") == int(entry["slot"]):
+                    info = item
+        return info
+
+    def series(self, position=0, modality=0):
+        """Timepoints and frames (T, H, W, C) of one position and modality"""
+        entries = self._select(position, modality)
+        entries = entries[np.argsort(entries["t"], kind="stable")]
+        frames = [self._read(e) for e in entries]
+        frames = np.stack(frames) if frames else np.empty([0] + list(self.meta["shape"] or []))
+        return entries["t"], frames
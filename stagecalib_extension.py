@@ -1,18 +1,24 @@
 from labthings.extensions import BaseExtension
 from labthings import find_component, fields
-from labthings.views import ActionView
+from labthings.views import ActionView, PropertyView
 from typing import Tuple
 from labthings.schema import Schema
 from labthings import find_extension
 
 import time
-import io  # Used in our capture action
+import json
+import os
 import logging
 import numpy as np
-try:
-    import cv2
-except:
-    print("CV2 is missing..still trying to run the Stagecalib extension")
+
+from acquisition_utils import SettleDetector, CaptureWriter, capture_in_background, capture_mean
+from acquisition_utils import stack_path, trace_path, quality_path, occupancy_path, append_jsonl
+from focus_utils import QualityGate, FocusSurface, load_focus_surface, save_focus_surface, focus_surface_file
+from timing_utils import timer
+from stack_utils import FrameStack
+from plate_utils import plan_path, measure_stage_speeds, search_sample
+from plate_utils import PlateMap, parse_well, parse_wells, well_name, image_shift, pixel_to_steps, well_offset
+from plate_utils import well_statistics, classify_occupancy, nominal_first_well
 
 # Used to run our stagecalib in a background thread
 from labthings import update_action_progress as update_task_progress
@@ -26,56 +32,194 @@ from openflexure_microscope.api.utilities.gui import build_gui
 
 stdvthres = 100
 mydarkval = 0
+# reachable stage positions: the stage homes to its lower end stops at (0, 0)
+stage_bounds = ((0, None), (0, None))
 
-def find_sample(camera, microscope, darkval=0, nsearch = 3, distsearch=1000):
-    # move as long as you find a brightness change
-
-    iiter = 0
+def find_sample(camera, microscope, darkval, nsearch = 3, distsearch=1000, radius=10000, min_delta=20):
+    """
+    Move along an outward square spiral until the sample is found
+
+    Args:
+        camera: camera for the low-res brightness probes
+        microscope: Microscope object
+        darkval (float): mean grey value of an empty position, e.g. measured at the homed origin
+        nsearch (int): number of consecutive bright probes needed to confirm the sample
+        distsearch (int): steps between two probes
+        radius (int): maximum distance (steps) from the start position
+        min_delta (float): brightness above darkval at which a probe counts as sample
+
+    Returns:
+        dict with "found", the final "position" (x, y, z), the "candidates"
+        [(x, y, score)] and the number of probes "n_probes"
+    """
     currentpos = microscope.stage.position
-    myvals = []
-    while True:
-        # snake scan
-        if iiter % 4 in (1, 2): dir_x = 1
-        else: dir_x = -1
-        if iiter % 4 in (2,3): dir_y = 1
-        else: dir_y = -1
-        
-        ix = dir_x*((iiter+1)// 4)
-        iy = dir_y*((iiter) // 4)
-
-        # frames behave weird
-        mymean = np.mean(capture_in_background(camera))
-        myvals.append(mymean)
-        print("Iter: "+str(iiter) + ", mean: "+str(mymean))
-        iiter += 1
-        
-        if mymean > 80 and iiter >0:
-            break
-
-        myx = currentpos[0]+(ix*distsearch)
-        myy = currentpos[1]+(iy*distsearch)
-        microscope.stage.move_abs((myx,myy,0))
-        
-        if iiter > 20:
-            microscope.stage.move_abs(currentpos)
-            break
-        
-            
-    return microscope.stage.position
 
-def capture_in_background(camera):
-    output = io.BytesIO()
-    camera.capture(output, use_video_port=True, resize=(320, 240))
-    frame_data = np.frombuffer(output.getvalue(), dtype=np.uint8)
-    frame = cv2.imdecode(frame_data, cv2.IMREAD_GRAYSCALE)
-    del output
-    return frame
+    def move(x, y):
+        microscope.stage.move_abs((int(x), int(y), currentpos[2]))
+
+    with timer.span("find sample"):
+        result = search_sample(move, lambda: capture_mean(camera), currentpos[:2], darkval, step=distsearch,
+                               radius=radius, min_delta=min_delta, n_confirm=nsearch, bounds=stage_bounds)
+    print("Sample "+("found" if result["found"] else "not found")+" after "+str(result["n_probes"])+" probes")
+    result["position"] = microscope.stage.position
+    return result
+
+def find_first_well(camera, microscope, darkval, pitch=9000):
+    """
+    Find the well A1 around its position predicted from the holder geometry
+
+    The spiral starts at A1 of the last registered plate map (the same holder)
+    or else at nominal_first_well. A probe step of a third of the pitch cannot
+    miss a well, and the search stops at the first bright probe, within one
+    pitch of the prediction.
+
+    Args:
+        camera: camera for the low-res brightness probes
+        microscope: Microscope object
+        darkval (float): mean grey value of an empty position
+        pitch (int): nominal well to well distance (steps)
+
+    Returns:
+        dict of find_sample
+    """
+    saved_map = PlateMap.load()
+    start = saved_map.position(0, 0) if saved_map is not None else nominal_first_well
+    print("Searching A1 around "+str((int(start[0]), int(start[1]))))
+    with timer.span("move"):
+        microscope.stage.move_abs((int(start[0]), int(start[1]), microscope.stage.position[2]))
+    return find_sample(camera, microscope, darkval, nsearch=1, distsearch=pitch // 3, radius=pitch)
+
+def register_plate(camera, microscope, first_well, pitch=9000, anchors=("A1", "A12", "H12", "H1"),
+                   n_center=2, calib_steps=300):
+    """
+    Register the well plate: centre a few anchor wells and fit the affine plate map
+
+    The camera is calibrated at the first well by two small test moves (the
+    image shift gives the steps per pixel). Each anchor well is then approached
+    at the position predicted from the wells registered so far and centred on
+    its bright disc, so the prediction of the next anchor is already better.
+
+    Args:
+        camera: camera for the low-res frames
+        microscope: Microscope object
+        first_well (tuple): approximate stage position of A1 (e.g. from find_first_well)
+        pitch (int): nominal well to well distance (steps)
+        anchors (tuple): names of the wells which are centred
+        n_center (int): centring iterations per well
+        calib_steps (int): length of the test moves for the pixel calibration
+
+    Returns:
+        PlateMap, also saved for later scans
+    """
+    z = microscope.stage.position[2]
+
+    def move(x, y):
+        with timer.span("move"):
+            microscope.stage.move_abs((int(round(x)), int(round(y)), z))
+
+    # steps per pixel from two test moves at the first well
+    move(first_well[0], first_well[1])
+    frame = capture_in_background(camera)
+    move(first_well[0] + calib_steps, first_well[1])
+    shift_x = image_shift(frame, capture_in_background(camera))
+    move(first_well[0], first_well[1] + calib_steps)
+    shift_y = image_shift(frame, capture_in_background(camera))
+    try:
+        steps_per_pixel = pixel_to_steps(shift_x, shift_y, calib_steps)
+    except np.linalg.LinAlgError:
+        print("Could not calibrate the camera on the well, registering without centring")
+        steps_per_pixel = None
+
+    plate_map = PlateMap(pitch, origin=first_well)
+    for name in anchors:
+        row, col = parse_well(name)
+        x, y = plate_map.position(row, col)
+        for _ in range(n_center if steps_per_pixel is not None else 0):
+            move(x, y)
+            offset, fill = well_offset(capture_in_background(camera))
+            if fill == 0 or fill > .95:
+                # no edge of the well in the field of view, nothing to centre on
+                break
+            x, y = np.array([x, y]) - steps_per_pixel @ offset
+        plate_map.add(row, col, x, y)
+        print("Registered "+name+" at "+str((int(x), int(y))))
+
+    print("Plate map residuals (steps): "+str(plate_map.residuals()))
+    plate_map.save()
+    return plate_map
+
+def prescan_occupancy(camera, microscope, positions, labels, path="serpentine", well_z=None, filename=None,
+                      empty=None):
+    """
+    Visit every well once without autofocus and classify it as occupied or empty
+
+    One low-res frame per well (after a short settle) is enough to tell
+    textured or shadowed wells from empty ones, so the repeated scans only
+    spend autofocus and capture time on wells with a sample.
+
+    Args:
+        camera: camera for the low-res frames
+        microscope: Microscope object
+        positions (array): (N, 2) stage positions of the wells
+        labels (list): well names
+        path (str): order of the wells, see plan_path
+        well_z (dict): optional focus position per well index, e.g. from the focus plane
+        filename (str): optional JSON file the occupancy mask is written to
+        empty (dict): optional well_statistics of a position known to be empty, see classify_occupancy
+
+    Returns:
+        dict well name -> True (occupied) / False (empty)
+    """
+    well_z = well_z or {}
+    settle = SettleDetector(lambda: capture_in_background(camera), timeout=.5, name="Occupancy pre-scan")
+    statistics = {}
+    plan = plan_path(positions, path, start=microscope.stage.position)
+    for i in plan["order"]:
+        with timer.span("move"):
+            microscope.stage.move_abs((int(positions[i, 0]), int(positions[i, 1]), well_z.get(i, microscope.stage.position[-1])))
+        _, frame = settle.wait()
+        statistics[labels[i]] = well_statistics(frame)
+    occupied = classify_occupancy(statistics, empty=empty)
+    print("Occupied wells: "+str(sum(occupied.values()))+"/"+str(len(occupied)))
+    if filename is not None:
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump({"occupied": occupied, "statistics": statistics, "empty_reference": empty, "time": time.time()}, f, indent=2)
+    return occupied
 
 ## Extension methods
+def focus_z(x, y, holder="default"):
+    """
+    Focus position at stage position (x, y) from the calibrated focus plane of a sample holder
+
+    Returns None if the holder has not been calibrated (task "Focus Calibration").
+    """
+    surface = load_focus_surface(holder)
+    if surface is None:
+        return None
+    return float(surface.predict(x, y))
+
+
+def focus_planes():
+    """All calibrated focus planes"""
+    try:
+        with open(focus_surface_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
 def move_stage(
     microscope,
     task_name,
     n_scans,
+    storage="files",
+    path="serpentine",
+    quality_gate=False,
+    wells="all",
+    holder="default",
+    skip_empty=False,
+    plate_map="register",
     metadata: dict = {}
 ):
 
@@ -87,81 +231,135 @@ def move_stage(
         elif task_name == 'Search Sample':            
             # Retrieve frame data
             camera = microscope.camera
-            sample_pos = find_sample(camera, microscope, nsearch = 5, distsearch=1000)
+            # the homed origin is off the sample, so its brightness is the empty baseline;
+            # the search itself starts where the user left the stage
+            startpos = tuple(microscope.stage.position)
+            microscope.stage.go_home(offsetx=0, offsety=0)
+            mydarkval = capture_mean(camera)
+            microscope.stage.move_abs(startpos)
+            return find_sample(camera, microscope, mydarkval, nsearch = 5, distsearch=1000)
+        elif task_name == "Register well plate":
+            microscope.stage.go_home(offsetx=0, offsety=0)
+            camera = microscope.camera
+            mydarkval = capture_mean(camera)
+            sample_pos = find_first_well(camera, microscope, darkval=mydarkval)["position"]
+            return register_plate(camera, microscope, sample_pos).to_dict()
         elif task_name == "Scan 96 well plate":
+            # check the selection before minutes of stage motion
+            selected = parse_wells(wells)
+
             # first we want to move the stage to the end position
             microscope.stage.go_home(offsetx=0, offsety=0)
             autofocus_extension = find_extension("org.openflexure.autofocus")
 
             # Retrieve frame data
             camera = microscope.camera   
-            
-            # estimate the mean value in the background
-            frame = capture_in_background(camera)  
-            mydarkval = np.mean(frame)
-            print("My darkval: "+str(mydarkval))     
 
-            N_sample_found = 0
-            # go and find the first well
-            for iter in range(15):
-                microscope.stage.move_rel((300, 300, 0))
-                frame = capture_in_background(camera)  
-                mymean = np.mean(frame)
-                if mymean > 80:
-                    N_sample_found += 1
-                    if N_sample_found > 3:
-                        # make sure you really found a sample
-                        break
-                print("My darkval: "+str(mymean))   
-
-            # save value for later
-            sample_pos = microscope.stage.position
-
-            # construct the scan positions
-            Nx = 12
-            Ny = 8
-            distmove = 9000
-            scanpositions = []
-            scanpositions.append((0,0,0))
-            
-            for iiter in range(Nx*Ny):
-                # snake scan
-                if ((1+iiter)%(Nx))==0: dir_x = 1
-                else: dir_x = 0
-                if (iiter//(Nx))%2: dir_y = -1
-                else: dir_y = 1
-                if(dir_x == 1): dir_y = 0
-                ix = distmove * dir_x
-                iy = distmove * dir_y
-                scanpositions.append((ix,iy,0))
-            scanpositions = np.array(scanpositions)
+            # the homed origin is off the plate: a reference for the empty wells of the pre-scan
+            empty_reference = well_statistics(capture_in_background(camera)) if skip_empty else None
+
+            # the map of the "Register well plate" task, if asked for and available
+            saved_map = PlateMap.load() if plate_map == "saved" else None
+            if plate_map == "saved" and saved_map is None:
+                print("No registered plate map, registering the plate")
+            if saved_map is not None:
+                plate_map = saved_map
+                sample_pos = tuple(plate_map.position(0, 0)) + (microscope.stage.position[-1],)
+            else:
+                # estimate the mean value in the background
+                mydarkval = capture_mean(camera)
+                print("My darkval: "+str(mydarkval))     
+
+                # map the plate from a few centred wells instead of stepping blindly from the first one;
+                # 12 wells along Y, 8 along X
+                distmove = 9000
+
+                # go and find the first well near its predicted position
+                sample_pos = find_first_well(camera, microscope, darkval=mydarkval, pitch=distmove)["position"]
+                plate_map = register_plate(camera, microscope, sample_pos, pitch=distmove)
+
+            # absolute centres of the selected wells
+            scanpositions = np.array([plate_map.position(row, col) for row, col in selected])
+            scanlabels = [well_name(row, col) for row, col in selected]
 
             # Location to store video
             folder = "WellplateScan"
             basename = generate_basename()
             filename = f"{basename}"
-            positionold = microscope.stage.position
-            for it in range(n_scans):
-                microscope.stage.move_abs(positionold)
-                for iiter in range(scanpositions.shape[0]):
-                    microscope.stage.move_rel((scanpositions[iiter,0],scanpositions[iiter,1],scanpositions[iiter,2]))
-                    # Run fast autofocus. Client should provide dz ~ 2000
-                    autofocus_dz = 3000
-                    autofocus_extension.fast_autofocus(microscope, dz=autofocus_dz)
-                    microscope.capture(
-                        filename=filename+"_96WellplateScan_"+str(it)+"_" + str(iiter), 
-                        folder=folder, 
-                        temporary=False
-                    )
+            timer.start_run(filename)
+            # images are written in the background while the stage moves to the next well
+            stack = FrameStack(stack_path(microscope, folder, filename)) if storage == "stack" else None
+            # with the quality gate, the wells are only autofocused in the first round and
+            # afterwards only if their tile is blurred
+            gate = QualityGate() if quality_gate else None
+            # start at the calibrated focus of the holder instead of autofocusing every well in the first round
+            surface = load_focus_surface(holder)
+            well_z = {}
+            if gate is not None and surface is not None:
+                well_z = {i: int(round(float(surface.predict(*p)))) for i, p in enumerate(scanpositions)}
+            if skip_empty:
+                # one cheap pass over the plate; the repeats only visit the wells with a sample
+                occupied = prescan_occupancy(camera, microscope, scanpositions, scanlabels, path,
+                                             well_z=well_z, filename=occupancy_path(microscope, folder, filename),
+                                             empty=empty_reference)
+                keep = [i for i, label in enumerate(scanlabels) if occupied[label]]
+                scanpositions = scanpositions[keep]
+                scanlabels = [scanlabels[i] for i in keep]
+                well_z = {j: well_z[i] for j, i in enumerate(keep) if i in well_z}
+            # the gate scores the first still frame after the move or the autofocus, not a motion-blurred one
+            settle = SettleDetector(lambda: capture_in_background(camera), timeout=1, name="Stage")
+            with CaptureWriter(microscope, stack=stack) as writer:
+                for it in range(n_scans if len(scanpositions) else 0):
+                    # every repetition starts where the last one ended instead of going back to the first well
+                    plan = plan_path(scanpositions, path, start=microscope.stage.position)
+                    print("Predicted travel time: "+str(round(plan["travel_time"], 1))+"s")
+                    for iiter in plan["order"]:
+                        with timer.span("move"):
+                            microscope.stage.move_abs((int(scanpositions[iiter,0]), int(scanpositions[iiter,1]), well_z.get(iiter, microscope.stage.position[-1])))
+                        # Run fast autofocus. Client should provide dz ~ 2000
+                        autofocus_dz = 3000
+                        refocused = gate is None or iiter not in well_z
+                        if refocused:
+                            with timer.span("autofocus"):
+                                autofocus_extension.fast_autofocus(microscope, dz=autofocus_dz)
+                        image_name = filename+"_96WellplateScan_"+str(it)+"_" + scanlabels[iiter]
+                        image_metadata = None
+                        if gate is not None:
+                            _, frame = settle.wait()
+                            scores = gate.check(iiter, frame, refocused=refocused)
+                            if scores["status"] == "blurred":
+                                print("Well "+str(iiter)+" is blurred, refocusing")
+                                with timer.span("autofocus"):
+                                    autofocus_extension.fast_autofocus(microscope, dz=autofocus_dz)
+                                _, frame = settle.wait()
+                                scores = gate.check(iiter, frame, refocused=True)
+                            well_z[iiter] = microscope.stage.position[-1]
+                            image_metadata = dict(microscope.metadata, quality=scores)
+                            append_jsonl(quality_path(microscope, folder, filename),
+                                         dict(scores, filename=image_name, round=it, well=scanlabels[iiter],
+                                              z=well_z[iiter], time=time.time()))
+                        writer.capture(
+                            filename=image_name, 
+                            folder=folder, 
+                            temporary=False,
+                            metadata=image_metadata,
+                            stack_key=(it, scanlabels[iiter], "Brightfield")
+                        )
 
                 
-                    # Much faster Capture but won't be added to the GUI
-                    # output = './openflexure/data/micrographs/' + folder + '/' + filename+"_96WellplateScan_" + str(iiter)
-                    # microscope.camera.capture(output)
+                        # Much faster Capture but won't be added to the GUI
+                        # output = './openflexure/data/micrographs/' + folder + '/' + filename+"_96WellplateScan_" + str(iiter)
+                        # microscope.camera.capture(output)
+
+            timer.export_trace(trace_path(microscope, folder, filename), run=filename)
 
 
             
-            microscope.stage.move_abs((sample_pos))        
+            microscope.stage.move_abs(tuple(int(p) for p in sample_pos))        
+            stats = {"wells": scanlabels, "writer": writer.stats()}
+            if stats["writer"]["n_errors"]:
+                print("Writing "+str(stats["writer"]["n_errors"])+" images failed")
+            return stats
 
 
 
@@ -173,33 +371,55 @@ def move_stage(
             camera = microscope.camera
 
             # estimate the mean value in the background
-            frame = capture_in_background(camera)  
-            mydarkval = np.mean(frame)
+            mydarkval = capture_mean(camera)
             print("My darkval: "+str(mydarkval))     
 
+            # the corners and the interior points of an n_points x n_points grid over the holder
+            myzero = find_sample(camera, microscope, darkval=mydarkval)["position"]
             posx_max = 60000
             posy_max = 100000
-            myposarray = np.array(((0,0,0), (posx_max,0,0),(0,posy_max,0),(-posx_max,0,0)))
-            myzero = ((0,0,0))
-            myoldspeed_x,myoldspeed_y,myoldspeed_z = microscope.stage.board.getspeed()
-            microscope.stage.board.setspeed(200,150,40)
+            n_points = 3
+            calibpositions = np.array([(myzero[0] + posx_max * ix / (n_points - 1), myzero[1] + posy_max * iy / (n_points - 1))
+                                       for iy in range(n_points) for ix in range(n_points)])
+
+            autofocus_extension = find_extension("org.openflexure.autofocus")
+            settle = SettleDetector(lambda: capture_in_background(camera), timeout=1, name="Focus Calibration")
+            surface = FocusSurface(order=1)
             for N in range(n_scans):
-                for i in range(myposarray.shape[0]):
-                    print("Move to: " +str(myposarray[i,:])+"mm")
-                    microscope.stage.move_rel((myposarray[i,0],myposarray[i,1],myposarray[i,2]))
-                    if N==0 :
-                       sample_pos = find_sample(camera, microscope,darkval=mydarkval)
-                       if i==0:
-                           myzero = sample_pos
-                    print("check focus")
-                    time.sleep(10)
-                microscope.stage.move_abs((myzero))
-            microscope.stage.board.setspeed(myoldspeed_x,myoldspeed_y,myoldspeed_z)                  
-            print("Done with stage calibration..")
+                plan = plan_path(calibpositions, "serpentine", start=microscope.stage.position)
+                for i in plan["order"]:
+                    print("Move to: " +str(calibpositions[i]))
+                    with timer.span("move"):
+                        microscope.stage.move_abs((int(calibpositions[i, 0]), int(calibpositions[i, 1]), microscope.stage.position[-1]))
+                    _, frame = settle.wait()
+                    if np.std(frame) < 3:
+                        # nothing to focus on here, look for the sample nearby
+                        if not find_sample(camera, microscope, darkval=mydarkval, radius=3000)["found"]:
+                            print("No sample near "+str(calibpositions[i])+", skipping")
+                            continue
+                    with timer.span("autofocus"):
+                        autofocus_extension.fast_autofocus(microscope, dz=3000)
+                    x, y, z = microscope.stage.position[:3]
+                    surface.add(x, y, z)
+                    print("Focus at "+str((x, y))+": "+str(z))
+            microscope.stage.move_abs((myzero))
+
+            if not surface.is_fitted:
+                print("Focus calibration failed: no sample found")
+                return None
+            save_focus_surface(surface, holder)
+            print("Done with focus calibration, residuals (steps): "+str(list(surface.residuals().values())))
+            return {"holder": holder, "anchors": surface.to_list(), "coefficients": surface.coefficients.tolist()}
 
         elif task_name == "Plate-Shaking":
             microscope.stage.do_plateshaking(d_shift=100, time_shake = n_scans)
 
+        elif task_name == "Measure Stage Speed":
+            # calibrate the travel time model used for planning the scan paths
+            speeds = measure_stage_speeds(microscope.stage)
+            print("Stage speeds (steps/s): "+str(speeds["speed"])+", overhead per move: "+str(speeds["overhead"])+"s")
+            return speeds
+
 
 ## Extension views
 class StageCalibAPI(ActionView):
@@ -213,6 +433,27 @@ class StageCalibAPI(ActionView):
         "n_scans": fields.Integer(
             missing=1, example=1, description="Number of roundtrips/scans"
         ),
+        "storage": fields.String(
+            missing="files", example="stack", description="Save single files or one chunked stack"
+        ),
+        "path": fields.String(
+            missing="serpentine", example="tsp", description="Order of the wells: raster, serpentine or tsp"
+        ),
+        "quality_gate": fields.Boolean(
+            missing=False, example=True, description="Only refocus wells whose tiles are blurred"
+        ),
+        "wells": fields.String(
+            missing="all", example="A1:B6,H12", description="Wells to scan: all, a list or rectangles"
+        ),
+        "holder": fields.String(
+            missing="default", example="96-well", description="Sample holder of the focus calibration"
+        ),
+        "skip_empty": fields.Boolean(
+            missing=False, example=True, description="Pre-scan the plate at low resolution and skip empty wells"
+        ),
+        "plate_map": fields.String(
+            missing="register", example="saved", description="Register the plate (register) or use the map of the Register well plate task (saved)"
+        ),
     }
 
 
@@ -221,6 +462,13 @@ class StageCalibAPI(ActionView):
     def post(self, args):
         task_name = args.get("task_name")
         n_scans = args.get("n_scans")
+        storage = args.get("storage")
+        path = args.get("path")
+        quality_gate = args.get("quality_gate")
+        wells = args.get("wells")
+        holder = args.get("holder") or "default"
+        skip_empty = args.get("skip_empty")
+        plate_map = args.get("plate_map")
 
         # Find our microscope component
         microscope = find_component("org.openflexure.microscope")
@@ -229,10 +477,26 @@ class StageCalibAPI(ActionView):
             microscope,
             task_name,
             n_scans,
+            storage=storage,
+            path=path,
+            quality_gate=quality_gate,
+            wells=wells,
+            holder=holder,
+            skip_empty=skip_empty,
+            plate_map=plate_map,
             metadata=microscope.metadata,
         )
 
 
+class FocusPlaneAPI(PropertyView):
+    """
+    Calibrated focus planes of all sample holders
+    """
+
+    def get(self):
+        return focus_planes()
+
+
 ## Extension GUI (OpenFlexure eV)
 # Alternate form without any dynamic parts
 extension_gui = {
@@ -250,7 +514,7 @@ extension_gui = {
                     "name": "task_name",
                     "label": "Task",
                     "value": "Focus Calibration",
-                    "options": ["Focus Calibration","Homing","Search Sample","Plate-Shaking" "Scan 96 well plate"],
+                    "options": ["Focus Calibration","Homing","Search Sample","Plate-Shaking", "Register well plate", "Scan 96 well plate", "Measure Stage Speed"],
                 },
                 {
                     "fieldType": "numberInput",
@@ -259,6 +523,53 @@ extension_gui = {
                     "min": 1,  # HTML number input attribute
                     "default": 1,  # HTML number input attribute
                 },
+                {
+                    "fieldType": "selectList",
+                    "name": "storage",
+                    "label": "Storage",
+                    "value": "files",
+                    "options": ["files", "stack"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "path",
+                    "label": "Order of the wells",
+                    "value": "serpentine",
+                    "options": ["raster", "serpentine", "tsp"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "quality_gate",
+                    "label": "Only refocus blurred wells",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
+                {
+                    "fieldType": "textInput",
+                    "name": "wells",
+                    "label": "Wells (all, A1,B3 or A1:B6)",
+                    "value": "all",
+                },
+                {
+                    "fieldType": "textInput",
+                    "name": "holder",
+                    "label": "Sample holder (focus calibration)",
+                    "value": "default",
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "skip_empty",
+                    "label": "Pre-scan and skip empty wells",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "plate_map",
+                    "label": "Plate map",
+                    "value": "register",
+                    "options": ["register", "saved"],
+                },
             ],
         }
     ],
@@ -272,9 +583,12 @@ stagecalib_extension = BaseExtension("org.openflexure.stagecalib_extension", ver
 
 # Add methods to your extension
 stagecalib_extension.add_method(move_stage, "move_stage")
+stagecalib_extension.add_method(focus_z, "focus_z")
+stagecalib_extension.add_method(focus_planes, "focus_planes")
 
 # Add API views to your extension
 stagecalib_extension.add_view(StageCalibAPI, "/stagecalib")
+stagecalib_extension.add_view(FocusPlaneAPI, "/stagecalib/focus-plane")
 
 # Add OpenFlexure eV GUI to your extension
 stagecalib_extension.add_meta("gui", build_gui(extension_gui, stagecalib_extension))
@@ -11,6 +11,11 @@ import logging
 # Used to run our timelapse in a background thread
 from labthings import update_action_progress as update_task_progress
 
+from acquisition_utils import SettleDetector, DeadlineScheduler, CaptureWriter, capture_in_background
+from acquisition_utils import stack_path, IlluminationScheduler, Checkpoint, checkpoint_path, trace_path
+from timing_utils import timer
+from stack_utils import FrameStack
+
 from openflexure_microscope.captures.capture_manager import (
     generate_basename,
 )
@@ -28,47 +33,104 @@ def acquire_timelapse(
     t_name,
     t_modality,
     i_laser=255,
+    settle_timeout=.2,
+    t_policy="skip",
+    storage="files",
+    keep_illumination=False,
+    resume=False,
     metadata: dict = {}
 ):
 
+    # the state of the run is checkpointed so that it can be resumed after a restart
+    checkpoint = Checkpoint(checkpoint_path(microscope, "timelapse"))
+    state = checkpoint.load() if resume else None
+    if state is not None:
+        # continue the same series with its original parameters and output location
+        print("Resuming timelapse "+state["filename"]+" at timepoint "+str(state["k_next"]))
+        filename, folder = state["filename"], state["folder"]
+        t_duration, t_period = state["t_duration"], state["t_period"]
+        t_modality, i_laser = state["t_modality"], state["i_laser"]
+        t_policy, storage = state["t_policy"], state["storage"]
+        keep_illumination = state["keep_illumination"]
+    else:
+        if resume:
+            print("Nothing to resume, starting a new timelapse")
+        state = {
+            "filename": filename, "folder": folder,
+            "t_duration": t_duration, "t_period": t_period,
+            "t_modality": list(t_modality), "i_laser": i_laser,
+            "t_policy": t_policy, "storage": storage,
+            "keep_illumination": keep_illumination,
+            "t_start": time.time(), "k_next": 0,
+        }
+
+    # tag the timing spans of this run for the percentiles and the trace
+    timer.start_run(filename)
 
     # Do recording
     t_duration *= 60 # convert minutes to seconds
     with microscope.camera.lock:
         #TO CHANGE VIDEO RESOLUTION RESIZE, UNCOMMENT THE LINES BELOW
-        iiter = 0
         
-        # save the time when starting the image acquisition
-        time_init = time.time()
+        # save the time when starting the image acquisition (of the original run if resumed)
+        time_init = state["t_start"]
 
         # compute number of images which will be taken..
         N_images = t_duration//t_period
-        
-        while((time.time()-time_init)<t_duration):
-            for i_modality in range(len(t_modality)):
-                print("Turning on modality illu: "+t_modality[i_modality])
-                if t_modality[i_modality]=='Fluorescence':
-                    microscope.stage.set_laser_intensity(i_laser)
-                    time.sleep(.2)
-                if t_modality[i_modality]=='Brightfield':
-                    microscope.stage.set_led(1)
-                    time.sleep(.2)                    
-                # Create a file to save the image to and Capture
-                microscope.capture(
-                    filename=filename+"_"+t_modality[i_modality] + "_" + str(iiter), 
-                    folder=folder, 
-                    temporary=False
-                )
-                microscope.stage.set_laser_intensity(0)
-                microscope.stage.set_led(0)
-            iiter += 1
+
+        # wait for the illumination to settle instead of a fixed delay
+        settle = SettleDetector(lambda: capture_in_background(microscope.camera),
+                                timeout=settle_timeout, name="Illumination")
+
+        # fire every timepoint at time_init + iiter*t_period so that the series doesn't drift;
+        # missed timepoints are skipped or taken back to back (t_policy), but after resuming
+        # from an outage only the last one is taken instead of the whole backlog
+        scheduler = DeadlineScheduler(t_period, duration=t_duration, policy=t_policy, t_start=time_init,
+                                      k_start=state["k_next"], max_backlog=1 if state["k_next"] else None)
+
+        # only send illumination commands (and wait for them) if the illumination really changes
+        illumination = IlluminationScheduler(microscope.stage, i_laser, settle=settle, keep_on=keep_illumination)
+
+        # optionally append all frames to one chunked stack instead of single files
+        stack = FrameStack(stack_path(microscope, folder, filename)) if storage == "stack" else None
+
+        # images are written in the background while we wait for the next timepoint
+        with CaptureWriter(microscope, stack=stack) as writer:
+            for iiter in scheduler:
+                for modality in illumination.order(t_modality, iiter):
+                    print("Turning on modality illu: "+modality)
+                    illumination.set(modality)
+                    # Create a file to save the image to and Capture
+                    writer.capture(
+                        filename=filename+"_"+modality + "_" + str(iiter), 
+                        folder=folder, 
+                        temporary=False,
+                        stack_key=(iiter, 0, modality)
+                    )
+                illumination.end_timepoint()
+
+                state["k_next"] = iiter + 1
+                if checkpoint.due():
+                    writer.flush()
+                    checkpoint.save(state)
             
-            # Update task progress (only does anyting if the function is running in a LabThings task)
-            progress_pct = ((iiter + 1) / N_images) * 100  # Progress, in percent
-            update_task_progress(progress_pct)
+                # Update task progress (only does anyting if the function is running in a LabThings task)
+                progress_pct = ((iiter + 1) / N_images) * 100  # Progress, in percent
+                update_task_progress(progress_pct)
+
+        illumination.off()
+        checkpoint.finish(state)
 
-            # wait until we want to take the next image
-            time.sleep(t_period)
+        stats = scheduler.stats()
+        stats["illumination"] = illumination.stats()
+        stats["writer"] = writer.stats()
+        stats["timing"] = timer.percentiles(run=filename)
+        stats["trace"] = timer.export_trace(trace_path(microscope, folder, filename), run=filename)
+        print("Timelapse done: "+str(stats["n_fired"])+" timepoints, "+str(stats["n_overruns"])+" overruns, "+str(stats["n_skipped"])+" skipped")
+        print("Illumination: "+str(stats["illumination"]["n_switches"])+" switches took "+str(stats["illumination"]["t_switch"])+"s")
+        if stats["writer"]["n_errors"]:
+            print("Writing "+str(stats["writer"]["n_errors"])+" images failed")
+        return stats
 
 
 
@@ -96,6 +158,18 @@ class TimeLapseAPI(ActionView):
         ),
         "select_modality": fields.List(
             fields.String, missing=[], allow_none=True
+        ),
+        "t_policy": fields.String(
+            missing="skip", example="skip", description="Missed timepoints: skip or compress"
+        ),
+        "storage": fields.String(
+            missing="files", example="stack", description="Save single files or one chunked stack"
+        ),
+        "keep_illumination": fields.Boolean(
+            missing=False, example=False, description="Keep the light on between timepoints"
+        ),
+        "resume": fields.Boolean(
+            missing=False, example=False, description="Resume the last (interrupted) timelapse"
         )
     }
 
@@ -106,6 +180,10 @@ class TimeLapseAPI(ActionView):
         i_laser = args.get("i_laser")
         t_name = args.get("t_name")
         t_modality = args.get("select_modality") or {}
+        t_policy = args.get("t_policy")
+        storage = args.get("storage")
+        keep_illumination = args.get("keep_illumination")
+        resume = args.get("resume")
 
         # Find our microscope component
         microscope = find_component("org.openflexure.microscope")
@@ -125,6 +203,10 @@ class TimeLapseAPI(ActionView):
             t_name=t_name,
             t_modality=t_modality,
             i_laser = i_laser,
+            t_policy = t_policy,
+            storage = storage,
+            keep_illumination = keep_illumination,
+            resume = resume,
             metadata=microscope.metadata,
         )
 
@@ -171,6 +253,34 @@ extension_gui = {
                     "label": "Select Imaging Modality",
                     "value": (["Brightfield", "Fluorescence"]),
                     "options": (["Brightfield", "Fluorescence"])
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "t_policy",
+                    "label": "Missed timepoints",
+                    "value": "skip",
+                    "options": ["skip", "compress"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "storage",
+                    "label": "Storage",
+                    "value": "files",
+                    "options": ["files", "stack"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "keep_illumination",
+                    "label": "Keep the light on between timepoints",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "resume",
+                    "label": "Continue the last interrupted timelapse",
+                    "value": "no",
+                    "options": ["no", "yes"],
                 }
             ],
         }
@@ -0,0 +1,132 @@
+from labthings.extensions import BaseExtension
+from labthings import fields
+from labthings.views import ActionView, PropertyView
+
+import os
+import time
+
+from timing_utils import timer
+
+# Used to convert our GUI dictionary into a complete eV extension GUI
+from openflexure_microscope.api.utilities.gui import build_gui
+
+## Extension methods
+def timing_stats(run=None, since=None):
+    """
+    Percentiles of the time spent per step (move, settle, autofocus, illumination, capture, write, ...)
+
+    Args:
+        run (str): only the spans of this run (e.g. the filename of a timelapse)
+        since (float): only the spans of the last N seconds
+    """
+    return {
+        "run": timer.last_run,
+        "n_spans": len(timer.spans),
+        "steps": timer.percentiles(run=run, since=None if since is None else time.time() - since),
+    }
+
+
+def export_trace(filename=None, run=None):
+    """
+    Write the recorded spans to a Chrome trace JSON file (chrome://tracing, ui.perfetto.dev)
+
+    Args:
+        filename (str): trace file (default: ~/openflexure/data/timing_trace.json)
+        run (str): only the spans of this run
+    """
+    filename = filename or os.path.expanduser("~/openflexure/data/timing_trace.json")
+    return timer.export_trace(filename, run=run)
+
+
+## Extension views
+class TimingAPI(PropertyView):
+    """
+    Percentiles of the time spent per step of all acquisition loops
+    """
+
+    def get(self):
+        return timing_stats()
+
+
+class TimingRunAPI(PropertyView):
+    """
+    Percentiles of the time spent per step of the most recently started run
+    """
+
+    def get(self):
+        return timing_stats(run=timer.last_run)
+
+
+class TimingTraceAPI(ActionView):
+    """
+    Export the recorded spans as a Chrome trace JSON file
+    """
+    args = {
+        "run": fields.String(
+            missing=None, allow_none=True, example="", description="Only spans of this run (empty: all)"
+        ),
+    }
+
+    def post(self, args):
+        return export_trace(run=args.get("run") or None)
+
+
+class TimingClearAPI(ActionView):
+    """
+    Forget all recorded spans
+    """
+
+    def post(self):
+        timer.clear()
+        return timing_stats()
+
+
+## Extension GUI (OpenFlexure eV)
+# Alternate form without any dynamic parts
+extension_gui = {
+    "icon": "timer",  # Name of an icon from https://material.io/resources/icons/
+    "forms": [  # List of forms. Each form is a collapsible accordion panel
+        {
+            "name": "Export a Chrome trace of the recorded steps",
+            "route": "/timing/trace",
+            "isTask": True,
+            "isCollapsible": False,
+            "submitLabel": "Export",
+            "schema": [
+                {
+                    "fieldType": "textInput",
+                    "name": "run",
+                    "label": "Run (empty: all)",
+                    "value": "",
+                },
+            ],
+        },
+        {
+            "name": "Clear the recorded steps",
+            "route": "/timing/clear",
+            "isTask": True,
+            "isCollapsible": True,
+            "submitLabel": "Clear",
+            "schema": [],
+        },
+    ],
+}
+
+
+## Create extension
+
+# Create your extension object
+timing_extension = BaseExtension("org.openflexure.timing_extension", version="0.0.0")
+
+# Add methods to your extension
+timing_extension.add_method(timing_stats, "timing_stats")
+timing_extension.add_method(export_trace, "export_trace")
+
+# Add API views to your extension
+timing_extension.add_view(TimingAPI, "/timing")
+timing_extension.add_view(TimingRunAPI, "/timing/run")
+timing_extension.add_view(TimingTraceAPI, "/timing/trace")
+timing_extension.add_view(TimingClearAPI, "/timing/clear")
+
+# Add OpenFlexure eV GUI to your extension
+timing_extension.add_meta("gui", build_gui(extension_gui, timing_extension))
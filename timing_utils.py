@@ -0,0 +1,120 @@
+"""
+Lightweight per-step timing of the acquisition loops
+
+Every step (stage move, settle, autofocus, illumination switch, capture,
+write, ...) is recorded as a span (name, start, duration, thread, run) into
+a process-wide ring buffer, so the cost is a couple of time.time() calls
+and memory stays bounded. The run is set per thread, so overlapping actions
+keep their own runs; work handed to another thread passes its run along:
+
+    from timing_utils import timer
+
+    with timer.span("move"):
+        microscope.stage.move_abs(position)
+
+    timer.percentiles()             # {"move": {"n": .., "p50": .., "p90": .., ...}, ...}
+    timer.export_trace("run.json")  # open in chrome://tracing or ui.perfetto.dev
+"""
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+Span = collections.namedtuple("Span", ["name", "t_start", "duration", "thread", "run", "args"])
+
+
+class Timer(object):
+    """
+    Ring buffer of timed spans
+
+    Args:
+        max_spans (int): number of spans kept; older spans are dropped
+    """
+
+    def __init__(self, max_spans=20000):
+        self.spans = collections.deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.last_run = None
+
+    @property
+    def run(self):
+        """Run of the calling thread (None outside of a run)"""
+        return getattr(self.local, "run", None)
+
+    def start_run(self, name):
+        """Tag all following spans of the calling thread with the run name (e.g. the filename of a timelapse)"""
+        self.local.run = name
+        self.last_run = name
+        return name
+
+    def record(self, name, t_start, duration, run=None, **args):
+        """Store one span, tagged with run or the run of the calling thread"""
+        run = self.run if run is None else run
+        span = Span(name, t_start, duration, threading.current_thread().name, run, args)
+        with self.lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """Time the body of the with statement as one span"""
+        t_start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, t_start, time.time() - t_start, **args)
+
+    def select(self, run=None, since=None):
+        with self.lock:
+            spans = list(self.spans)
+        if run is not None:
+            spans = [s for s in spans if s.run == run]
+        if since is not None:
+            spans = [s for s in spans if s.t_start >= since]
+        return spans
+
+    def percentiles(self, run=None, since=None, q=(50, 90, 99)):
+        """Count, mean, total, max and percentiles of the duration (s) of every step"""
+        durations = {}
+        for span in self.select(run, since):
+            durations.setdefault(span.name, []).append(span.duration)
+        stats = {}
+        for name, values in durations.items():
+            values = np.array(values)
+            stats[name] = {"n": len(values), "mean": float(np.mean(values)),
+                           "total": float(np.sum(values)), "max": float(np.max(values))}
+            for p, value in zip(q, np.percentile(values, q)):
+                stats[name]["p%d" % p] = float(value)
+        return stats
+
+    def trace(self, run=None, since=None):
+        """Spans in the Chrome trace event format"""
+        events = [{
+            "name": span.name,
+            "ph": "X",
+            "ts": span.t_start * 1e6,
+            "dur": span.duration * 1e6,
+            "pid": os.getpid(),
+            "tid": span.thread,
+            "args": dict(span.args, run=span.run),
+        } for span in self.select(run, since)]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_trace(self, filename, run=None, since=None):
+        """Write the spans (of one run) to a Chrome trace JSON file"""
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(self.trace(run, since), f, default=str)
+        return filename
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+
+# shared by all extensions
+timer = Timer()
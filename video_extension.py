@@ -13,6 +13,8 @@ from openflexure_microscope.captures.capture_manager import (
     generate_basename,
 )
 
+from timing_utils import timer
+
 # Used to convert our GUI dictionary into a complete eV extension GUI
 from openflexure_microscope.api.utilities.gui import build_gui
 
@@ -45,10 +47,11 @@ def record_video(
         if(microscope.camera.camera.revision=='ALVIUM'):
             if not os.path.exists(output.file.split('.h264')[0]):
                 os.makedirs(output.file.split('.h264')[0])
-            microscope.camera.start_recording(output=output.file)#, video_framerate)
-            logging.info('Changed framerate to: {}'.format(video_framerate))
-            time.sleep(video_length)
-            microscope.camera.stop_recording()
+            with timer.span("record video", filename=filename):
+                microscope.camera.start_recording(output=output.file)#, video_framerate)
+                logging.info('Changed framerate to: {}'.format(video_framerate))
+                time.sleep(video_length)
+                microscope.camera.stop_recording()
         else:   
             #if video_framerate != microscope.camera.camera.framerate:
                 #microscope.camera.stop_stream()
@@ -60,12 +63,15 @@ def record_video(
             myzero = microscope.stage.position
             myoldspeed_x,myoldspeed_y,myoldspeed_z = microscope.stage.board.getspeed()
             microscope.stage.board.setspeed(10,10,40)
-            microscope.camera.start_recording(output=output.file, fmt=video_format)
-            microscope.stage.move_rel((steps_2_move[0],steps_2_move[1],0)) 
-            microscope.camera.stop_recording()
+            with timer.span("record video", filename=filename):
+                microscope.camera.start_recording(output=output.file, fmt=video_format)
+                with timer.span("move"):
+                    microscope.stage.move_rel((steps_2_move[0],steps_2_move[1],0)) 
+                microscope.camera.stop_recording()
             # reset speed
             microscope.stage.board.setspeed(myoldspeed_x,myoldspeed_y,myoldspeed_z)               
-            microscope.stage.move_rel((-steps_2_move[0],-steps_2_move[1],0)) 
+            with timer.span("move"):
+                microscope.stage.move_rel((-steps_2_move[0],-steps_2_move[1],0)) 
 
            # microscope.camera.camera.framerate = old_stream_framerate
             microscope.camera.stream_resolution = old_stream_resolution
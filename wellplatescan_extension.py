@@ -18,6 +18,14 @@ import time  # Used in our wellscan function
 import numpy as np
 
 
+from acquisition_utils import SettleDetector, DeadlineScheduler, CaptureWriter, capture_in_background
+from acquisition_utils import stack_path, Checkpoint, checkpoint_path, trace_path
+from acquisition_utils import quality_path, append_jsonl
+from timing_utils import timer
+from focus_utils import FocusSurface, choose_anchors, QualityGate, DriftTracker, load_focus_surface
+from plate_utils import grid_positions, plan_path
+from stack_utils import FrameStack
+
 # Used in our wellscan function
 from openflexure_microscope.captures.capture_manager import (
     generate_basename,
@@ -27,13 +35,40 @@ from openflexure_microscope.captures.capture_manager import (
 from openflexure_microscope.api.utilities.gui import build_gui
 
 ## Extension methods
+def autofocus_at(microscope, autofocus, x, y, z, autofocus_dz, autofocus_Nz, drift=None):
+    """
+    Move to (x, y, z), run the autofocus there and return the focus position
+
+    With a DriftTracker the z stack is centred on the predicted focus of the
+    position and only as wide as the prediction is uncertain; if the focus is
+    found at the edge of the narrow window, the full range is searched again.
+    """
+    key = str(x)+"_"+str(y)
+    dz, Nz = autofocus_dz, autofocus_Nz
+    if drift is not None:
+        z, dz, Nz = drift.window(key, time.time(), z, autofocus_dz, autofocus_Nz)
+    with timer.span("move"):
+        microscope.stage.move_abs((x, y, z))
+    with timer.span("autofocus", n_z=Nz):
+        autofocus.autofocus(microscope, np.linspace(-dz, dz, Nz))
+    z_focus = microscope.stage.position[-1]
+    if dz < autofocus_dz and abs(z_focus - z) >= .9 * dz:
+        print("Focus at the edge of the predicted window, searching the full range")
+        with timer.span("autofocus", n_z=autofocus_Nz):
+            autofocus.autofocus(microscope, np.linspace(-autofocus_dz, autofocus_dz, autofocus_Nz))
+        z_focus = microscope.stage.position[-1]
+    if drift is not None:
+        drift.update(key, time.time(), z_focus)
+    return z_focus
 
 
 
 
 def wellscan(microscope, autofocus, offset_x, offset_y, 
     	Nx=3, Ny=3, t_period=60, well_to_well_steps = 9000,
-        autofocus_dz=2000, autofocus_Nz=11):
+        autofocus_dz=2000, autofocus_Nz=11, settle_timeout=1, storage="files", resume=False,
+        focus_mode="wells", n_anchors=4, focus_order=1, focus_tolerance=200, path="serpentine",
+        n_cycles=0, quality_gate=False, focus_drift=False, holder=""):
     """
     Save a set of images in a wellscan
 
@@ -41,19 +76,91 @@ def wellscan(microscope, autofocus, offset_x, offset_y,
         microscope: Microscope object
         offset_x (int): Number of images to take
         offset_y (int/float): Time, in seconds, between sequential captures
+        resume (bool): continue the last interrupted wellscan from its checkpoint
+        focus_mode (str): "wells" (default) autofocuses every well every 10th scan,
+            "surface" autofocuses n_anchors wells and fits a focus surface, "gated" autofocuses every
+            well in the first scan and afterwards only wells which fail the quality gate
+        n_anchors (int): number of anchor wells for the focus surface
+        focus_order (int): order of the focus surface (1 = plane)
+        focus_tolerance (float): deviation (steps) from the surface at which all anchors are refocused
+        path (str): order of the wells, "raster", "serpentine" or "tsp" (shortest predicted travel time)
+        n_cycles (int): stop after this many scans (0: until the action is cancelled)
+        quality_gate (bool): check the sharpness of every tile before the capture and
+            refocus blurred tiles; the scores are saved in <name>_quality.jsonl
+        focus_drift (bool): predict the focus of every well from its past autofocus results
+            and only autofocus in a narrow window around the prediction
+        holder (str): sample holder whose calibrated focus plane gives the Z of the first scan
+            (see the Focus Calibration task of the stagecalib extension)
     """
-    base_file_name = generate_basename()
-    folder = "wellscan_{}".format(base_file_name)
-
-    Nx = int(Nx)
-    Ny = int(Ny)
-    t_period = int(t_period)
-    well_to_well_steps = int(well_to_well_steps)
+    # the state of the scan is checkpointed so that it can be resumed after a restart
+    checkpoint = Checkpoint(checkpoint_path(microscope, "wellscan"))
+    state = checkpoint.load() if resume else None
+    if state is None:
+        if resume:
+            print("Nothing to resume, starting a new wellscan")
+        base_file_name = generate_basename()
+        state = {
+            "base_file_name": base_file_name,
+            "folder": "SCAN_{}".format(base_file_name),
+            "offset_x": offset_x, "offset_y": offset_y,
+            "Nx": int(Nx), "Ny": int(Ny), "t_period": int(t_period),
+            "well_to_well_steps": int(well_to_well_steps),
+            "autofocus_dz": autofocus_dz, "autofocus_Nz": autofocus_Nz,
+            "storage": storage,
+            "focus_mode": focus_mode, "n_anchors": int(n_anchors),
+            "focus_order": int(focus_order), "focus_tolerance": focus_tolerance,
+            "focus_anchors": [], "path": path, "order": None, "n_cycles": int(n_cycles or 0),
+            "quality_gate": bool(quality_gate) or focus_mode == "gated",
+            "focus_drift": bool(focus_drift), "drift_tracks": {},
+            "holder": holder,
+            # position in the scan: next experiment (cycle) and well, focus map
+            "i_experiment": 0, "i_well": 0, "i_image": 0,
+            "offset_z": None, "focus_pos_list": [],
+        }
+    else:
+        print("Resuming wellscan "+state["base_file_name"]+" at experiment "+str(state["i_experiment"])+", well "+str(state["i_well"]))
+
+    # continue the same series with its original parameters and output location
+    base_file_name, folder = state["base_file_name"], state["folder"]
+    offset_x, offset_y = state["offset_x"], state["offset_y"]
+    Nx, Ny, t_period = state["Nx"], state["Ny"], state["t_period"]
+    well_to_well_steps = state["well_to_well_steps"]
+    autofocus_dz, autofocus_Nz = state["autofocus_dz"], state["autofocus_Nz"]
+    storage = state["storage"]
+    focus_mode = state.get("focus_mode", "wells")
+
+    path = state.get("path", "raster")
+    n_cycles = state.get("n_cycles", 0)
+
+    # refocus only tiles which are blurred; empty tiles are recorded but not refocused
+    gate = QualityGate() if state.get("quality_gate") else None
+
+    # extrapolate the (thermal) focus drift of every well from its past autofocus results
+    drift = DriftTracker(tracks=state.get("drift_tracks")) if state.get("focus_drift") else None
+
+    # absolute positions and (x, y) indices of all wells
+    well_positions, well_labels = grid_positions(offset_x, offset_y, Nx, Ny, well_to_well_steps)
+    well_positions = [(int(x), int(y)) for x, y in well_positions]
+
+    # focus surface through a few anchor wells, the other wells get their Z from it
+    anchor_positions = [well_positions[i] for i in choose_anchors(well_positions, state.get("n_anchors", 4))]
+    focus = FocusSurface(order=state.get("focus_order", 1), tolerance=state.get("focus_tolerance", 200),
+                         anchors=state.get("focus_anchors"))
+
+    # the calibrated focus plane of the holder replaces the autofocus of the first scan
+    plane = load_focus_surface(state["holder"]) if state.get("holder") else None
+    if plane is not None and not focus.is_fitted:
+        print("Starting at the calibrated focus plane of "+state["holder"])
+        for x, y in anchor_positions:
+            focus.add(x, y, int(round(float(plane.predict(x, y)))))
+
+    # tag the timing spans of this run for the percentiles and the trace
+    timer.start_run(base_file_name)
     
     # Take exclusive control over both the camera and stage
     with microscope.camera.lock, microscope.stage.lock:
         # microscope parameters
-        offset_z = microscope.stage.position[-1]
+        offset_z = microscope.stage.position[-1] if state["offset_z"] is None else state["offset_z"]
 
         name_experiment = base_file_name+"_test_large_scan_new_"
 
@@ -63,72 +170,180 @@ def wellscan(microscope, autofocus, offset_x, offset_y,
         microscope.stage.move_abs((offset_x,offset_y,offset_z))
         #autofocus.autofocus(microscope, np.linspace(-1500, 1500, 11))
 
-        i_well = 0
-        i_experiment = 0
- 
-        print("Start scan")
-        #%%
-        focus_pos_list = []
-        folder = "SCAN_{}".format(base_file_name)
-        i_image = 0
-
-
-        time_last = 0
-        while(True):
-            if time.time()-time_last>t_period:
+    i_well = 0
+    i_experiment = state["i_experiment"]
+    # wells of the current experiment which were done before the restart
+    i_well_resume = state["i_well"]
  
-                time_last = time.time()
+    print("Start scan")
+    #%%
+    focus_pos_list = list(state["focus_pos_list"])
+    if plane is not None and focus_mode == "gated" and not focus_pos_list:
+        focus_pos_list = [int(round(float(plane.predict(x, y)))) for x, y in well_positions]
+    i_image = state["i_image"]
+
+
+    # wait for the stage to settle instead of a fixed delay
+    settle = SettleDetector(lambda: capture_in_background(microscope.camera),
+                            timeout=settle_timeout, name="Stage")
+
+    # images are written in the background while the stage moves to the next well
+    # optionally append all frames to one chunked stack instead of single files
+    stack = FrameStack(stack_path(microscope, folder, base_file_name)) if storage == "stack" else None
+
+    # sleep until the next scan instead of spinning, stop early when the action is cancelled
+    stopping = getattr(current_action(), "stopping", None)
+    n_remaining = max(n_cycles - i_experiment, 0) if n_cycles else None
+    scheduler = DeadlineScheduler(t_period, n_points=n_remaining, policy="skip", stop_event=stopping)
+
+    with CaptureWriter(microscope, stack=stack) as writer:
+        for _ in scheduler:
+            # hold the camera and stage only during a scan, so that the stream and
+            # other actions can run in between
+            with microscope.camera.lock, microscope.stage.lock:
                 i_well = 0
                 last_offset_z_row = offset_z
-                for wellpos_y in range(Nx):
-                    for wellpos_x in range(Nx):
+
+                # anchors which were focused in this scan
+                focused = set()
+                if focus_mode == "surface":
+                    # the surface needs all anchors before the first well is imaged
+                    for anchor in anchor_positions:
+                        if anchor not in focus.anchors:
+                            z_guess = focus.predict(*anchor) if focus.is_fitted else offset_z
+                            focus.add(*anchor, autofocus_at(microscope, autofocus, *anchor, int(z_guess),
+                                                            autofocus_dz, autofocus_Nz, drift))
+                            focused.add(anchor)
+
+                # visit the wells in the order with the shortest predicted travel time,
+                # keep the order of an interrupted scan when resuming
+                if i_well_resume and state.get("order"):
+                    order = state["order"]
+                else:
+                    z_wells = [focus.predict(*p) for p in well_positions] if focus.is_fitted else None
+                    plan = plan_path(well_positions, path, start=microscope.stage.position, z=z_wells)
+                    order = plan["order"]
+                    print("Predicted travel time: "+str(round(plan["travel_time"], 1))+"s")
+                state["order"] = order
+
+                for i_well, i_pos in enumerate(order):
+                    if stopping is not None and stopping.is_set():
+                        break
+                    if i_well < i_well_resume:
+                        # already acquired before the restart
+                        continue
+                    wellpos_x, wellpos_y = well_labels[i_pos]
+
+                    if last_offset_z_row == 0:
+                        offset_z = last_offset_z_row
+
+                    print("Move microscope")
+                    current_x, current_y = well_positions[i_pos]
+                    # an autofocus at this tile makes its frame a trusted quality reference
+                    refocused = False
+                
+                    if focus_mode == "surface":
+                        anchor = (current_x, current_y)
+                        if anchor in anchor_positions and anchor not in focused and focus.needs_refresh(*anchor, i_experiment):
+                            z = autofocus_at(microscope, autofocus, current_x, current_y,
+                                             int(round(float(focus.predict(*anchor)))), autofocus_dz, autofocus_Nz, drift)
+                            residual = focus.add(*anchor, z)
+                            focused.add(anchor)
+                            refocused = True
+                            print("Refocused anchor "+str(anchor)+", model was off by "+str(residual))
+                        offset_z = int(round(float(focus.predict(current_x, current_y))))
+                    elif (focus_mode == "wells" and (i_experiment % 10)== 0) or (focus_mode == "gated" and (
+                            len(focus_pos_list) != len(well_positions) or focus_pos_list[i_pos] is None)):
+                        if len(focus_pos_list) != len(well_positions) or (focus_mode == "wells" and i_well == 0):
+                            focus_pos_list = [None] * len(well_positions)
+                    
+                        offset_z = autofocus_at(microscope, autofocus, current_x, current_y, offset_z,
+                                                autofocus_dz, autofocus_Nz, drift)
+                        refocused = True
+
+                        focus_pos_list[i_pos] = offset_z
 
                         if last_offset_z_row == 0:
-                            offset_z = last_offset_z_row
-
-                        print("Move microscope")
-                        current_x, current_y = offset_x+well_to_well_steps*wellpos_x,offset_y+well_to_well_steps*wellpos_y
-                        
-                        if (i_experiment % 10)== 0:
-                            if i_well == 0:
-                                focus_pos_list = []
-                            
-                            microscope.stage.move_abs((current_x, current_y, offset_z))
-                            autofocus.autofocus(microscope, np.linspace(-autofocus_dz, autofocus_dz, autofocus_Nz))
-                            offset_z = microscope.stage.position[-1]                                
-
-                            focus_pos_list.append(offset_z)
-
-                            if last_offset_z_row == 0:
-                                last_offset_z_row = offset_z
-                        else:
-                            offset_z = focus_pos_list[i_well]
+                            last_offset_z_row = offset_z
+                    else:
+                        offset_z = focus_pos_list[i_pos]
+                        if drift is not None:
+                            # extrapolate the drift since the last autofocus instead of reusing a stale value
+                            z_pred, _ = drift.predict(str(current_x)+"_"+str(current_y), time.time())
+                            offset_z = offset_z if z_pred is None else int(round(z_pred))
+                    with timer.span("move"):
                         microscope.stage.move_abs((current_x, current_y, offset_z))
-                        print("offset_z:"+str(offset_z))
-
-                        bayer = False
-                        tags = ["xy_scan_"+str(wellpos_x)+"_"+str(wellpos_y)]
-                        temporary =  False
-                        use_video_port = True
-                        filename = name_experiment+str(i_experiment)+"_"+str(i_well)+"_"+str(i_image)+"_"+str(wellpos_x)+"_"+str(wellpos_y)
-
-                        time.sleep(1) # wait for debouncing
-                        microscope.capture(filename=filename,
-                            folder=folder,
-                            temporary=temporary,
-                            use_video_port=use_video_port,
-                            bayer=bayer,
-                            tags=tags,
-                        )
-                        print(filename)
-
-                        i_image += 1
-
-                        i_well += 1
+                    print("offset_z:"+str(offset_z))
+
+                    bayer = False
+                    tags = ["xy_scan_"+str(wellpos_x)+"_"+str(wellpos_y)]
+                    temporary =  False
+                    use_video_port = True
+                    filename = name_experiment+str(i_experiment)+"_"+str(i_well)+"_"+str(i_image)+"_"+str(wellpos_x)+"_"+str(wellpos_y)
+
+                    _, frame = settle.wait() # wait for debouncing
+                    metadata = None
+                    if gate is not None:
+                        # the settled low-res frame tells us whether the tile is worth capturing
+                        scores = gate.check(i_pos, frame, refocused=refocused)
+                        if scores["status"] == "blurred":
+                            print("Tile "+str(wellpos_x)+"_"+str(wellpos_y)+" is blurred, refocusing")
+                            offset_z = autofocus_at(microscope, autofocus, current_x, current_y, offset_z,
+                                                    autofocus_dz, autofocus_Nz, drift)
+                            if focus_mode != "surface" and len(focus_pos_list) == len(well_positions):
+                                focus_pos_list[i_pos] = offset_z
+                            _, frame = settle.wait()
+                            scores = gate.check(i_pos, frame, refocused=True)
+                        metadata = dict(microscope.metadata, quality=scores)
+                        append_jsonl(quality_path(microscope, folder, base_file_name),
+                                     dict(scores, filename=filename, experiment=i_experiment,
+                                          well=[wellpos_x, wellpos_y], z=offset_z, time=time.time()))
+                    writer.capture(filename=filename,
+                        folder=folder,
+                        temporary=temporary,
+                        use_video_port=use_video_port,
+                        bayer=bayer,
+                        tags=tags,
+                        metadata=metadata,
+                        stack_key=(i_experiment, str(wellpos_x)+"_"+str(wellpos_y), "Brightfield"),
+                    )
+                    print(filename)
+
+                    i_image += 1
+
+                    state.update(i_experiment=i_experiment, i_well=i_well + 1, i_image=i_image,
+                                 offset_z=offset_z, focus_pos_list=focus_pos_list,
+                                 focus_anchors=focus.to_list(),
+                                 drift_tracks=drift.to_dict() if drift is not None else {})
+                    if checkpoint.due():
+                        writer.flush()
+                        checkpoint.save(state)
+
+                if stopping is not None and stopping.is_set():
+                    # keep the checkpoint of the unfinished scan, it can be resumed
+                    writer.flush()
+                    checkpoint.save(state)
+                    print("Wellscan cancelled at experiment "+str(i_experiment)+", well "+str(state["i_well"]))
+                    break
 
                 i_experiment += 1
-
-                
+                i_well_resume = 0
+                state.update(i_experiment=i_experiment, i_well=0)
+                writer.flush()
+                checkpoint.save(state)
+                timer.export_trace(trace_path(microscope, folder, base_file_name), run=base_file_name)
+
+    if n_cycles and i_experiment >= n_cycles:
+        checkpoint.finish(state)
+    stats = scheduler.stats()
+    stats["n_experiments"] = i_experiment
+    stats["writer"] = writer.stats()
+    if gate is not None:
+        stats["quality"] = gate.stats()
+    print("Wellscan done: "+str(i_experiment)+" scans, "+str(stats["n_skipped"])+" periods skipped")
+    if stats["writer"]["n_errors"]:
+        print("Writing "+str(stats["writer"]["n_errors"])+" images failed")
+    return stats
 
 
 ## Extension views
@@ -143,6 +358,12 @@ class wellscanAPI(ActionView):
             "offset_y": fields.Number(
                 missing=1, required=False, example=2000, description="Offset Y"
             ),
+            "t_period": fields.Number(
+                missing=60, example=60, description="Time (s) from the start of one scan to the next"
+            ),
+            "n_cycles": fields.Integer(
+                missing=0, example=10, description="Number of scans (0: until cancelled)"
+            ),
             "N_x": fields.Number(
                 missing=1, required=False, example=3, description="Number wells X"
             ),
@@ -158,6 +379,30 @@ class wellscanAPI(ActionView):
             "well_to_well_steps": fields.Number(
                 example=9000, description="Well to Well steps"
             ),            
+            "storage": fields.String(
+                missing="files", example="stack", description="Save single files or one chunked stack"
+            ),
+            "resume": fields.Boolean(
+                missing=False, example=False, description="Resume the last (interrupted) wellscan"
+            ),
+            "focus_mode": fields.String(
+                missing="wells", example="surface", description="Autofocus at every well (wells), a focus surface through anchor wells (surface) or only blurred wells (gated)"
+            ),
+            "n_anchors": fields.Integer(
+                missing=4, example=4, description="Number of anchor wells of the focus surface"
+            ),
+            "path": fields.String(
+                missing="serpentine", example="tsp", description="Order of the wells: raster, serpentine or tsp"
+            ),
+            "quality_gate": fields.Boolean(
+                missing=False, example=True, description="Refocus and recapture blurred tiles"
+            ),
+            "focus_drift": fields.Boolean(
+                missing=False, example=True, description="Predict the focus drift and autofocus in a narrow window"
+            ),
+            "holder": fields.String(
+                missing="", example="96-well", description="Sample holder with a calibrated focus plane"
+            ),
         }
     
     def post(self, args):
@@ -167,6 +412,8 @@ class wellscanAPI(ActionView):
         # parse arguments
         offset_x = args.get("offset_x")
         offset_y = args.get("offset_y")
+        t_period = args.get("t_period")
+        n_cycles = args.get("n_cycles")
 
         N_x = args.get("N_x")
         N_y = args.get("N_y")
@@ -174,11 +421,21 @@ class wellscanAPI(ActionView):
         well_to_well_steps = args.get("well_to_well_steps")
         autofocus_dz = args.get("autofocus_dz")
         autofocus_Nz = args.get("autofocus_Nz")
+        storage = args.get("storage")
+        resume = args.get("resume")
+        focus_mode = args.get("focus_mode")
+        n_anchors = args.get("n_anchors")
+        path = args.get("path")
+        quality_gate = args.get("quality_gate")
+        focus_drift = args.get("focus_drift")
+        holder = args.get("holder")
 
         # Create and start "wellscan", running in a background task
         return wellscan(microscope, autofocus, offset_x, offset_y, N_x, N_y,
                 t_period, well_to_well_steps,
-                autofocus_dz, autofocus_Nz)
+                autofocus_dz, autofocus_Nz, storage=storage, resume=resume,
+                focus_mode=focus_mode, n_anchors=n_anchors, path=path, n_cycles=n_cycles,
+                quality_gate=quality_gate, focus_drift=focus_drift, holder=holder)
         
 ## Extension GUI (OpenFlexure eV)
 # Alternate form without any dynamic parts
@@ -219,6 +476,20 @@ extension_gui = {
                     "label": "Number wells Y",
                     "min": 0,  # HTML number input attribute
                     "default": 3,  # HTML number input attribute
+                },
+                {
+                    "fieldType": "numberInput",
+                    "name": "t_period",
+                    "label": "Time between two scans (seconds)",
+                    "min": 0,  # HTML number input attribute
+                    "default": 60,  # HTML number input attribute
+                },
+                {
+                    "fieldType": "numberInput",
+                    "name": "n_cycles",
+                    "label": "Number of scans (0: until cancelled)",
+                    "min": 0,  # HTML number input attribute
+                    "default": 0,  # HTML number input attribute
                 },
 		        {
                     "fieldType": "numberInput",
@@ -241,6 +512,61 @@ extension_gui = {
                     "min": 0,  # HTML number input attribute
                     "default": 9000,  # HTML number input attribute
                 },
+                {
+                    "fieldType": "selectList",
+                    "name": "storage",
+                    "label": "Storage",
+                    "value": "files",
+                    "options": ["files", "stack"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "focus_mode",
+                    "label": "Focus",
+                    "value": "wells",
+                    "options": ["wells", "surface", "gated"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "focus_drift",
+                    "label": "Predict the focus drift (narrow autofocus)",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "quality_gate",
+                    "label": "Refocus blurred tiles",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
+                {
+                    "fieldType": "numberInput",
+                    "name": "n_anchors",
+                    "label": "Number of anchor wells for the focus surface",
+                    "min": 1,  # HTML number input attribute
+                    "default": 4,  # HTML number input attribute
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "path",
+                    "label": "Order of the wells",
+                    "value": "serpentine",
+                    "options": ["raster", "serpentine", "tsp"],
+                },
+                {
+                    "fieldType": "textInput",
+                    "name": "holder",
+                    "label": "Sample holder with a focus calibration (optional)",
+                    "value": "",
+                },
+                {
+                    "fieldType": "selectList",
+                    "name": "resume",
+                    "label": "Continue the last interrupted wellscan",
+                    "value": "no",
+                    "options": ["no", "yes"],
+                },
             ],
         }
     ],